@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+EB_INCREMENT = int(1e9)
+MAX_EFFECTIVE_BALANCE = 32 # in units of EB_INCREMENT
+
+def reward_tables(summary_e, summary_e1):
+    # per-effective-balance base, inclusion, target and head rewards, indexed
+    # by effective balance - 1. the products of balances overflow 64 bits so
+    # the tables are calculated exactly with python integers first
+    ab = summary_e1['active']
+    sqrt_ab = math.isqrt(ab)
+    base_reward, i_reward, t_reward, h_reward = [], [], [], []
+    for eb in range(1, MAX_EFFECTIVE_BALANCE + 1):
+        br = (eb * EB_INCREMENT * 16) // sqrt_ab
+        base_reward.append(br)
+        i_reward.append((br * summary_e['attesting']) // ab)
+        t_reward.append((br * summary_e['target'])    // ab)
+        h_reward.append((br * summary_e['head'])      // ab)
+
+    return {
+        'base'     : np.array(base_reward, dtype=np.int64),
+        'inclusion': np.array(i_reward, dtype=np.int64),
+        'target'   : np.array(t_reward, dtype=np.int64),
+        'head'     : np.array(h_reward, dtype=np.int64)
+    }
+
+def min_inclusion_delays(filled_slots):
+    # distance from each slot of the epoch to the next filled slot, given the
+    # 64 filled slot flags for this epoch and the next
+    filled = np.flatnonzero(np.asarray(filled_slots, dtype=bool))
+    slots = np.arange(32)
+    return filled[np.searchsorted(filled, slots + 1)] - slots
+
+def epoch_attestation_rewards(
+    tables,
+    min_delays,
+    attestors,
+    attestor_slots,
+    effective_balance,
+    included,
+    target_correct,
+    head_correct,
+    inclusion_delay
+):
+    # calculate the attestation reward and shortfalls of every scheduled
+    # attestor in one epoch. attestors holds validator indices and
+    # attestor_slots the slot (0-31) each was scheduled for, and min_delays
+    # holds the minimum inclusion delay of each slot; the remaining arrays
+    # are indexed by validator index. results are aligned with attestors
+
+    br_table = tables['base']
+    max_d_table = (
+        (br_table - br_table // 8)[np.newaxis, :]
+        // np.asarray(min_delays, dtype=np.int64)[:, np.newaxis]
+    )
+    max_table = (
+        tables['inclusion'] + tables['target'] + tables['head']
+    )[np.newaxis, :] + max_d_table
+
+    eb = effective_balance[attestors] - 1
+    br = br_table[eb]
+    i_r = tables['inclusion'][eb]
+    t_r = tables['target'][eb]
+    h_r = tables['head'][eb]
+    max_d_reward = max_d_table[attestor_slots, eb]
+    max_reward = max_table[attestor_slots, eb]
+
+    inc = included[attestors]
+    target = inc & target_correct[attestors]
+    head = inc & head_correct[attestors]
+    delay = np.where(inc, inclusion_delay[attestors], 1)
+
+    dr = (br - br // 8) // delay
+    zero = np.zeros_like(br)
+
+    att_reward = np.where(
+        inc,
+        i_r + dr + np.where(target, t_r, -br) + np.where(head, h_r, -br),
+        -3 * br
+    )
+
+    return {
+        'max_attestation_reward': max_reward,
+        'attestation_reward'    : att_reward,
+        'shortfall_missed'      : np.where(inc, zero, max_reward + 3 * br),
+        'shortfall_target'      : np.where(inc & ~target, t_r + br, zero),
+        'shortfall_head'        : np.where(inc & ~head, h_r + br, zero),
+        'shortfall_delay'       : np.where(inc, max_d_reward - dr, zero)
+    }
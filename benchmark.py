@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import data_sources
+from chaind_extras import ChainDB
+from instrumentation import Metrics
+from synthetic_chain import SyntheticChain, load_postgres, save
+from validator_epoch_extras import (
+    parallel_epochs,
+    pipelined_epochs,
+    reference_epochs,
+    vectorized_epochs
+)
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+def run_validator_epoch_extras(args, source, metrics):
+    # process epochs [start, start + n) from an empty extras table
+    with metrics.stage('setup'):
+        chaind = ChainDB(
+            source,
+            reset=True,
+            prefetch_window=args.window,
+            write_batch_size=args.batch_size,
+            checkpoint_interval=args.checkpoint_interval,
+            metrics=metrics,
+            write_queue_depth=args.pipeline
+        )
+    start = args.start
+    end = min(start + args.n_epochs, chaind.get_latest_summary_epoch() - 1)
+
+    if args.processes > 1:
+        epochs = parallel_epochs(
+            chaind, start, end, args.processes, max(args.window, 1)
+        )
+    elif args.engine == 'python':
+        epochs = reference_epochs(chaind, start, end)
+    elif args.pipeline:
+        epochs = pipelined_epochs(chaind, start, end, args.pipeline)
+    else:
+        epochs = vectorized_epochs(chaind, start, end)
+
+    for e in epochs:
+        chaind.insert_epoch_extras(e)
+        metrics.epoch_done(e)
+    chaind.flush()
+    return metrics.epochs, len(chaind.validators)
+
+def run_epoch_extras(args, source, metrics):
+    # epoch_extras.py only runs as a script, so it is run in a child process
+    # (on the same data source) which reports its own stage timings
+    source.create_epoch_extras_table(reset=True)
+    n = source.latest_summary_epoch() - 1
+    n_validators = len(source.validators()['activation_epoch'])
+
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'epoch_extras.py'
+    )
+    metrics_path = os.path.abspath('epoch_extras_metrics.jsonl')
+    command = [sys.executable, script, '--metrics', metrics_path]
+    if args.data is not None:
+        command += ['--data', source.directory]
+    elif args.dsn is not None:
+        command += ['--dsn', args.dsn]
+    with metrics.stage('total'):
+        subprocess.run(
+            command,
+            check=True,
+            stdout=subprocess.DEVNULL
+        )
+    with open(metrics_path) as f:
+        metrics.merge(json.loads(f.readlines()[-1]))
+    return n, n_validators
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="benchmark the epoch loops against a chaind data source"
+    )
+    parser.add_argument(
+        '-t', '--target', default='validator_epoch_extras',
+        choices=('validator_epoch_extras', 'epoch_extras')
+    )
+    parser.add_argument(
+        '--generate', action='store_true',
+        help="first replace the chaind tables (or --data directory) with a "
+             "synthetic chain (destroys any existing chaind data there)"
+    )
+    parser.add_argument('--validators', type=int, default=20000)
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-s', '--start', type=int, default=0)
+    parser.add_argument('-n', '--n-epochs', type=int, default=50)
+    parser.add_argument(
+        '-e', '--engine', choices=('python', 'numpy'), default='numpy'
+    )
+    parser.add_argument('-w', '--window', type=int, default=16)
+    parser.add_argument('-b', '--batch-size', type=int, default=8)
+    parser.add_argument('-k', '--checkpoint-interval', type=int, default=0)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--pipeline', type=int, default=0, metavar='DEPTH')
+    parser.add_argument(
+        '-o', '--output', default='benchmarks.jsonl',
+        help="append the results to this JSON lines file"
+    )
+    data_sources.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+
+    if args.generate:
+        chain = SyntheticChain(
+            n_validators=args.validators, n_epochs=args.epochs, seed=args.seed
+        )
+        with metrics.stage('generate'):
+            if args.data is not None:
+                # including the caches derived from the previous data
+                shutil.rmtree(args.data, ignore_errors=True)
+                save(chain, args.data)
+            else:
+                source = data_sources.PostgresSource(args.dsn)
+                with source.connection(autocommit=False) as connection:
+                    load_postgres(chain, connection)
+                source.close()
+
+    source = data_sources.from_args(args)
+
+    # run in a scratch directory so that the benchmark database does not
+    # share the tmp/ caches (e.g. the effective balance index) of a real one.
+    # file data sources keep their caches in the data directory
+    output = os.path.abspath(args.output)
+    os.chdir(tempfile.mkdtemp(prefix='benchmark_'))
+
+    start_time = time.perf_counter()
+    if args.target == 'epoch_extras':
+        n, n_validators = run_epoch_extras(args, source, metrics)
+    else:
+        n, n_validators = run_validator_epoch_extras(args, source, metrics)
+    seconds = time.perf_counter() - start_time
+
+    result = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'target': args.target,
+        'engine': args.engine,
+        'processes': args.processes,
+        'pipeline': args.pipeline,
+        'window': args.window,
+        'batch_size': args.batch_size,
+        'checkpoint_interval': args.checkpoint_interval,
+        'validators': n_validators,
+        'epochs': n,
+        'seconds': seconds,
+        'epochs_per_second': n / seconds if seconds else None,
+        'peak_rss_mb': max(
+            peak_rss_mb(), peak_rss_mb(resource.RUSAGE_CHILDREN)
+        ),
+        'stages': metrics.snapshot()['stages'],
+        'counters': metrics.snapshot()['counters']
+    }
+
+    print(f"{n} epochs of {n_validators} validators in {seconds:.2f}s "
+          f"({result['epochs_per_second']:.2f} epochs/s), "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    for stage, s in sorted(result['stages'].items()):
+        print(f"  {stage:>32}: {s['seconds']:8.2f}s {s['calls']:8d} calls")
+
+    with open(output, 'a') as f:
+        f.write(json.dumps(result) + '\n')
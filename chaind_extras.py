@@ -1,263 +1,411 @@
-import json
-import sys
-
-import psycopg2
-from psycopg2.extras import execute_values
-
-FUTURE_EPOCH = 2**64 - 1 # as defined in eth2 spec
-EB_INCREMENT = int(1e9)
-
-DROP_TABLE_QUERY = "DROP TABLE IF EXISTS t_validator_epoch_extras"
-
-CREATE_TABLE_QUERY = (
-    "CREATE TABLE IF NOT EXISTS t_validator_epoch_extras ("
-    "    f_epoch bigint NOT NULL, "
-    "    f_validator_index bigint NOT NULL, "
-    "    f_attestation_slot bigint, "
-    "    f_attestation_reward bigint , "
-    "    f_max_attestation_reward bigint, "
-    "    f_shortfall_missed bigint, "
-    "    f_shortfall_target bigint, "
-    "    f_shortfall_head bigint, "
-    "    f_shortfall_delay bigint, "
-    "    f_block_reward bigint, "
-    "    f_missed_block_reward bigint, "
-    "    CONSTRAINT i_validator_epoch_extras_1 "
-    "    PRIMARY KEY (f_validator_index, f_epoch) "
-    ")"
+import os
+
+import numpy as np
+
+from attestation_rewards import min_inclusion_delays
+from data_sources import PostgresSource
+from effective_balances import EffectiveBalanceIndex
+from efficiency_report import clear_cache
+from extras_writer import BackgroundWriter
+from filled_slots import FilledSlotIndex
+from fingerprints import REORG_DEPTH, EpochFingerprints, first_affected_epoch
+from instrumentation import Metrics
+from validator_store import (
+    ACCUMULATOR_FIELDS,
+    FIELDS,
+    METADATA_FIELDS,
+    ValidatorStore
 )
 
-CREATE_INDEX_QUERY = (
-    "CREATE INDEX IF NOT EXISTS i_validator_epoch_extras_2 "
-    "ON t_validator_epoch_extras (f_epoch)"
-)
-
-VALIDATORS_QUERY = (
-    "SELECT f_index, f_activation_epoch, f_exit_epoch, f_slashed, f_public_key "
-    "FROM t_validators ORDER BY f_index"
-)
-
-EPOCH_EXTRAS_QUERY = (
-    "SELECT f_validator_index, f_attestation_reward, f_max_attestation_reward,"
-    "    f_shortfall_missed, f_shortfall_target, f_shortfall_head,"
-    "    f_shortfall_delay, f_block_reward, f_missed_block_reward "
-    "FROM t_validator_epoch_extras WHERE f_epoch = %d"
-)
-
-IMPAIRED_VALIDATOR_QUERY = (
-    "SELECT DISTINCT f_validator_index FROM t_validator_balances "
-    "WHERE f_effective_balance <> 32000000000"
-)
-
-EFFECTIVE_BALANCE_QUERY = (
-    "SELECT f_effective_balance FROM t_validator_balances "
-    "WHERE f_validator_index = %d ORDER BY f_epoch"
-)
-
-EPOCH_SUMMARY_QUERY = (
-    "SELECT f_active_balance, f_attesting_balance, f_target_correct_balance, "
-    "    f_head_correct_balance FROM t_epoch_summaries WHERE f_epoch = %d"
-)
-
-BLOCKS_QUERY = (
-    "SELECT f_slot FROM t_blocks WHERE f_slot BETWEEN %d AND %d AND f_canonical"
-)
-
-VALIDATOR_EPOCH_SUMMARY_QUERY = (
-    "SELECT f_validator_index, f_proposer_duties, f_proposals_included, "
-    "    f_attestation_included, f_attestation_target_correct, "
-    "    f_attestation_head_correct, f_attestation_inclusion_delay "
-    "FROM t_validator_epoch_summaries WHERE f_epoch = %d"
-)
-
-COMMITTEE_QUERY = (
-    "SELECT f_committee FROM t_beacon_committees WHERE f_slot = %d"
-)
-
-PROPOSERS_QUERY = (
-    "SELECT f_validator_index FROM t_proposer_duties "
-    "WHERE f_slot BETWEEN %d AND %d ORDER BY f_slot"
-)
-
-BALANCE_CHANGE_QUERY = (
-    "SELECT f_balance FROM t_validator_balances "
-    "WHERE f_validator_index = %d AND f_epoch IN (%d, %d)"
-    "ORDER BY f_epoch"
-)
-
-INSERT_QUERY = "INSERT INTO t_validator_epoch_extras VALUES %s"
-
-DELETE_QUERY = "DELETE FROM t_validator_epoch_extras WHERE f_epoch = %d"
-
 class ChainDB:
+    # chain data for the epoch loops, read from a data source (by default
+    # the chaind PostgreSQL database). a source passed in may be shared
+    # with other instances and is left open, to be closed by the caller
+
     def __init__(
         self,
-        user='chain',
-        host='127.0.0.1',
-        database='chain',
-        password='medalla',
-        reset=False
+        source=None,
+        reset=False,
+        prefetch_window=0,
+        write_batch_size=1,
+        binary_copy=True,
+        checkpoint_interval=0,
+        read_only=False,
+        metrics=None,
+        write_queue_depth=0,
+        reorg_depth=REORG_DEPTH,
+        validators=None
     ):
-        self.connection = psycopg2.connect(
-            user=user, host=host, database=database, password=password
+        self.owns_source = source is None
+        self.source = PostgresSource() if source is None else source
+        self.metrics = Metrics() if metrics is None else metrics
+
+        # number of epochs loaded per prefetch (0 queries every epoch/slot)
+        self.prefetch_window = prefetch_window
+        self.window = None
+
+        # effective balances which differ from 32 ETH, indexed by epoch, and
+        # filled slot flags and minimum inclusion delays of complete epochs
+        self.read_only = read_only
+        self.effective_balances = EffectiveBalanceIndex(
+            self.source.cache_path('effective_balances')
+        )
+        self.filled_slots = FilledSlotIndex(
+            self.source.cache_path('filled_slots')
         )
-        self.connection.autocommit = True
-        self.cursor = self.connection.cursor()
-
-        if reset:
-            self.cursor.execute(DROP_TABLE_QUERY)
-
-        self.cursor.execute(CREATE_TABLE_QUERY)
-        self.cursor.execute(CREATE_INDEX_QUERY)
-
-        self.cursor.execute(VALIDATORS_QUERY)
-        self.validators = [{
-            'index'                 : r[0],
-            'activation_epoch'      : FUTURE_EPOCH if r[1] is None else r[1],
-            'exit_epoch'            : FUTURE_EPOCH if r[2] is None else r[2],
-            'slashed'               : r[3],
-            'slashed_slot'          : None,
-            'slasher'               : False,
-            'redeposit'             : False,
-            'pubkey'                : r[4].hex(),
-            'attestation_reward'    : 0,
-            'max_attestation_reward': 0,
-            'shortfall_missed'      : 0,
-            'shortfall_target'      : 0,
-            'shortfall_head'        : 0,
-            'shortfall_delay'       : 0,
-            'block_reward'          : 0,
-            'missed_block_reward'   : 0
-        } for r in self.cursor.fetchall()]
-
-        epoch = self.get_latest_extras_epoch()
-        if epoch is not None:
-            self.cursor.execute(EPOCH_EXTRAS_QUERY % self.epoch)
-            for r in self.cursor.fetchall():
-                self.validators[r[0]]['attestation_reward'] = r[1]
-                self.validators[r[0]]['max_attestation_reward'] = r[2]
-                self.validators[r[0]]['shortfall_missed'] = r[3]
-                self.validators[r[0]]['shortfall_target'] = r[4]
-                self.validators[r[0]]['shortfall_head'] = r[5]
-                self.validators[r[0]]['shortfall_delay'] = r[6]
-                self.validators[r[0]]['block_reward'] = r[7]
-                self.validators[r[0]]['missed_block_reward'] = r[8]
-
-        # get balances for impaired validators
 
-        try:
-            with open('tmp/effective_balances.json') as f:
-                print("loading impaired validator balances from file")
-                tmp = json.load(f)
-                self.effective_balances = {}
-                for k in tmp:
-                    self.effective_balances[int(k)] = tmp[k]
-        except FileNotFoundError:
-            print("identifying impaired validators")
-            self.cursor.execute(IMPAIRED_VALIDATOR_QUERY)
-            impaired_validators = [r[0] for r in self.cursor.fetchall()]
-            self.effective_balances = {}
-            for i, validator_index in enumerate(impaired_validators):
-                self.cursor.execute(EFFECTIVE_BALANCE_QUERY % validator_index)
-                self.effective_balances[validator_index] = [
-                    r[0] // EB_INCREMENT for r in cursor.fetchall()
-                ]
-
-            with open('tmp/effective_balances.json', 'w') as f:
-                json.dump(self.effective_balances, f)
+        # read-only instances (e.g. parallel workers) only fetch chain data
+        # and do not touch t_validator_epoch_extras
+        self.writer = None
+        self.rollback_epoch = None
+        if not read_only:
+            # epoch extras are written on a separate transactional connection,
+            # optionally from a background thread
+            self.writer = self.source.extras_writer(
+                write_batch_size,
+                binary_copy,
+                checkpoint_interval,
+                self.metrics
+            )
+            if write_queue_depth:
+                self.writer = BackgroundWriter(self.writer, write_queue_depth)
+            self.source.create_extras_tables(reset)
+
+            # digests of the chain data the extras were calculated from
+            self.fingerprints = EpochFingerprints(
+                self.source.cache_path('validator_epoch_extras.fingerprints')
+            )
+            with self.metrics.stage('query:fingerprints'):
+                if reset:
+                    clear_cache(self.source)
+                    self.fingerprints.truncate(0)
+                else:
+                    self.rollback(reorg_depth)
+                self.fingerprints.extend(self.source)
+
+            self.effective_balances.extend(self.source)
+            with self.metrics.stage('query:filled_slots'):
+                self.filled_slots.extend(self.source)
+
+        # validator state as of the last epoch with extras, from the state
+        # saved by the previous run if it is for that epoch, otherwise from
+        # the data source. a store passed in (e.g. the parent's, for fetch
+        # threads and worker processes) is used as it is
+        self.epoch = None if read_only else self.get_latest_extras_epoch()
+        self.head = None if read_only else \
+            self._query('chain_head', self.source.chain_head)
+        self.state_path = self.source.cache_path('validator_state.npz')
+        state = None if self.epoch is None else self._load_state()
+        if validators is not None:
+            self.validators = validators
+        elif state is not None:
+            self.validators = state
+        else:
+            self.validators = ValidatorStore.from_columns(
+                self._query('validators', self.source.validators)
+            )
+            if self.epoch is not None:
+                rows = self.source.validator_epoch_extras(self.epoch)
+                for i, field in enumerate(ACCUMULATOR_FIELDS):
+                    self.validators.columns[field][rows[:, 1]] = \
+                        rows[:, i + 3]
+        if self.epoch is not None:
+            self.writer.set_baseline(np.column_stack([
+                self.validators.columns[field] for field in ACCUMULATOR_FIELDS
+            ]))
 
     def __del__(self):
-        self.cursor.close()
-        self.connection.close()
+        if self.writer is not None:
+            self.writer.close()
+        if self.owns_source:
+            self.source.close()
+
+    def rollback(self, depth=REORG_DEPTH):
+        # if the chain data of any of the last depth epochs has changed since
+        # the extras were calculated (e.g. after a reorg), delete the extras
+        # of the epochs which depend on it, so that they are recalculated
+        # from the state of the last unaffected epoch
+        changed = self.fingerprints.first_change(self.source, depth)
+        if changed is None:
+            return
+        self.rollback_epoch = first_affected_epoch(changed)
+        self.source.rollback_extras(self.rollback_epoch)
+        self.fingerprints.truncate(changed)
+        self.effective_balances.truncate(changed)
+        self.filled_slots.truncate(changed)
+        clear_cache(self.source)
+
+    def _load_state(self):
+        # the saved validator state if it is for the current extras epoch
+        # (None otherwise). its validator metadata is only used if the chain
+        # head has not moved since; otherwise the validators are read again
+        # and the rest of the state is carried over
+        if not os.path.exists(self.state_path):
+            return None
+        try:
+            store, epoch, head = ValidatorStore.load(self.state_path)
+        except (OSError, KeyError, ValueError):
+            return None
+        if epoch != self.epoch:
+            return None
+        if head == self.head:
+            return store
+
+        validators = ValidatorStore.from_columns(
+            self._query('validators', self.source.validators)
+        )
+        n = len(store)
+        if len(validators) < n:
+            return None
+        for field in FIELDS:
+            if field not in METADATA_FIELDS:
+                validators.columns[field][:n] = store.columns[field]
+        return validators
+
+    def save_state(self):
+        # commit the buffered epochs and save the validator state as of the
+        # last of them, for the next run to start from
+        if self.writer is None or self.epoch is None:
+            return
+        self.flush()
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        self.validators.save(self.state_path, self.epoch, self.head)
+
+    def _query(self, name, method, *args):
+        # call a data source method, recording its time, round trip and row
+        # count
+        with self.metrics.query(name):
+            result = method(*args)
+        if isinstance(result, list):
+            self.metrics.rows(name, len(result))
+        return result
 
     def get_latest_block(self):
-        query = "SELECT MAX(f_slot) FROM t_blocks WHERE f_canonical"
-        self.cursor.execute(query)
-        return self.cursor.fetchone()[0]
+        return self._query('latest_block', self.source.latest_block)
 
     def get_latest_summary_epoch(self):
-        query = "SELECT MAX(f_epoch) FROM t_epoch_summaries"
-        self.cursor.execute(query)
-        return self.cursor.fetchone()[0]
+        return self._query('latest_summary', self.source.latest_summary_epoch)
 
     def get_latest_extras_epoch(self):
-        query = "SELECT MAX(f_epoch) FROM t_validator_epoch_extras"
-        self.cursor.execute(query)
-        return self.cursor.fetchone()[0]
+        return self._query('latest_extras', self.source.latest_extras_epoch)
+
+    def prefetch(self, epoch, n_epochs=None):
+        # load the chain data needed to process epochs [epoch, epoch + n)
+        # using one range query per table instead of per-slot round trips
+        n_epochs = self.prefetch_window if n_epochs is None else n_epochs
+        end = epoch + n_epochs
+        window = {
+            'start'      : epoch,
+            'end'        : end,
+            'summaries'  : {},
+            'filled'     : {},
+            'committees' : {},
+            'proposers'  : {},
+            'balances'   : {}
+        }
+
+        # epoch summaries and canonical blocks are also needed for epoch end
+        summaries = self._query(
+            'epoch_summaries', self.source.epoch_summaries, epoch, end
+        )
+        for r in summaries:
+            window['summaries'][r[0]] = {
+                'active': r[1],
+                'attesting': r[2],
+                'target': r[3],
+                'head': r[4]
+            }
+
+        # canonical blocks are only queried for epochs past the slot index
+        first = max(epoch, self.filled_slots.n_epochs)
+        for e in range(first, end + 1):
+            window['filled'][e] = [False] * 32
+        if first <= end:
+            slots = self._query(
+                'blocks', self.source.canonical_slots, first * 32, end * 32 + 31
+            )
+            for slot in slots:
+                window['filled'][slot // 32][slot % 32] = True
+
+        committees = self._query(
+            'committees', self.source.committees, epoch * 32, end * 32 - 1
+        )
+        for r in committees:
+            window['committees'].setdefault(r[0], []).extend(r[1])
+
+        # proposer duties are shifted by one slot (see get_shifted_proposers)
+        for e in range(epoch, end):
+            window['proposers'][e] = []
+        duties = self._query(
+            'proposer_duties',
+            self.source.proposer_duties,
+            epoch * 32 + 1,
+            end * 32
+        )
+        for r in duties:
+            window['proposers'][(r[0] - 1) // 32].append(r[1])
+
+        proposers = {i for p in window['proposers'].values() for i in p}
+        if proposers:
+            balances = self._query(
+                'proposer_balances',
+                self.source.balances,
+                sorted(proposers),
+                epoch + 1,
+                end + 1
+            )
+            for r in balances:
+                window['balances'][(r[0], r[1])] = r[2]
+
+        self.window = window
+
+    def _prefetched(self, epoch, tail=0):
+        # return the prefetched window covering epoch, moving it if needed;
+        # tail allows lookups one epoch past the end of the window
+        if not self.prefetch_window:
+            return None
+        w = self.window
+        if w is None or not w['start'] <= epoch < w['end'] + tail:
+            self.prefetch(max(epoch - tail, 0))
+            w = self.window
+        return w
 
     def get_epoch_summary_balances(self, epoch):
-        self.cursor.execute(EPOCH_SUMMARY_QUERY % epoch)
-        result = self.cursor.fetchone()
+        w = self._prefetched(epoch, tail=1)
+        if w is not None and epoch in w['summaries']:
+            return w['summaries'][epoch]
+
+        result = self._query(
+            'epoch_summaries', self.source.epoch_summaries, epoch, epoch
+        )[0]
         return {
-            'active': result[0],
-            'attesting': result[1],
-            'target': result[2],
-            'head': result[3]
+            'active': result[1],
+            'attesting': result[2],
+            'target': result[3],
+            'head': result[4]
         }
 
     def get_filled_slots(self, epoch):
+        if epoch < self.filled_slots.n_epochs:
+            e0 = epoch * 32
+            return self.filled_slots.filled(e0, e0 + 31).tolist()
+
+        w = self._prefetched(epoch, tail=1)
+        if w is not None:
+            return w['filled'][epoch].copy()
+
         filled_slots = [False] * 32
         e0 = epoch * 32
-        self.cursor.execute(BLOCKS_QUERY % (e0, e0 + 31))
-        for r in self.cursor.fetchall():
-            filled_slots[r[0] % 32] = True
+        for slot in self._query(
+            'blocks', self.source.canonical_slots, e0, e0 + 31
+        ):
+            filled_slots[slot % 32] = True
         return filled_slots
 
+    def get_min_inclusion_delays(self, epoch):
+        # distance from each slot of the epoch to the next filled slot
+        e0 = epoch * 32
+        if e0 + 32 <= self.filled_slots.n_resolved:
+            return self.filled_slots.min_inclusion_delays(e0, e0 + 31)
+        return min_inclusion_delays(
+            self.get_filled_slots(epoch) + self.get_filled_slots(epoch + 1)
+        )
+
     def load_validator_epoch_summary(self, epoch):
-        self.cursor.execute(VALIDATOR_EPOCH_SUMMARY_QUERY % epoch)
-        for r in self.cursor.fetchall():
-            v = self.validators[r[0]]
-            if r[0] in self.effective_balances:
-                v['effective_balance'] = self.effective_balances[r[0]][
-                    epoch - v['activation_epoch']
-                ]
-            else:
-                v['effective_balance'] = 32
-            v['proposer_duties'] = r[1]
-            v['proposals_included'] = r[2]
-            v['attestation_included'] = r[3]
-            v['target_correct'] = r[4]
-            v['head_correct'] = r[5]
-            v['inclusion_delay'] = r[6]
+        for field, values in self.get_validator_epoch_summary(epoch).items():
+            self.validators.columns[field][:] = values
+
+    def get_validator_epoch_summary(self, epoch):
+        # per-validator summary for the epoch as arrays indexed by validator
+        n = len(self.validators)
+        if epoch >= self.effective_balances.n_epochs and not self.read_only:
+            with self.metrics.stage('query:effective_balances'):
+                self.effective_balances.extend(self.source)
+        summary = {
+            'effective_balance'   : self.effective_balances.get(epoch, n),
+            'proposer_duties'     : np.zeros(n, dtype=np.int64),
+            'proposals_included'  : np.zeros(n, dtype=np.int64),
+            'attestation_included': np.zeros(n, dtype=bool),
+            'target_correct'      : np.zeros(n, dtype=bool),
+            'head_correct'        : np.zeros(n, dtype=bool),
+            'inclusion_delay'     : np.zeros(n, dtype=np.int64)
+        }
+
+        name = 'validator_epoch_summaries'
+        with self.metrics.query(name):
+            rows = self.source.validator_epoch_summaries(epoch)
+        index = rows.pop('index')
+        self.metrics.rows(name, len(index))
+        for field, values in rows.items():
+            summary[field][index] = values
+
+        return summary
+
+    def get_epoch_attestors(self, epoch):
+        # scheduled attestors for the epoch and the slot (0-31) of each
+        indices, slots = [], []
+        for s in range(32):
+            attestors = self.get_scheduled_attestors(epoch * 32 + s)
+            indices.extend(attestors)
+            slots.extend([s] * len(attestors))
+        return (
+            np.array(indices, dtype=np.int64), np.array(slots, dtype=np.int64)
+        )
 
     def get_scheduled_attestors(self, slot):
-        self.cursor.execute(COMMITTEE_QUERY % slot)
-        return [
-            el for sl in self.cursor.fetchall() for ssl in sl for el in ssl
-        ]
+        w = self._prefetched(slot // 32)
+        if w is not None:
+            return w['committees'].get(slot, [])
+
+        rows = self._query('committees', self.source.committees, slot, slot)
+        return [i for _, committee in rows for i in committee]
 
     def get_shifted_proposers(self, epoch):
-        e1 = epoch * 32 + 1
-        self.cursor.execute(PROPOSERS_QUERY % (e1, e1 + 31))
-        return [r[0] for r in self.cursor.fetchall()]
+        w = self._prefetched(epoch)
+        if w is not None:
+            return w['proposers'][epoch]
 
-    def get_balance_delta(self, val_index, epoch):
-        params = (val_index, epoch + 1, epoch + 2)
-        self.cursor.execute(BALANCE_CHANGE_QUERY % params)
-        balance = [r[0] for r in self.cursor.fetchall()]
-        return balance[1] - balance[0]
+        e1 = epoch * 32 + 1
+        rows = self._query(
+            'proposer_duties', self.source.proposer_duties, e1, e1 + 31
+        )
+        return [r[1] for r in rows]
+
+    def get_balance_deltas(self, epoch, val_indices):
+        # balance change of each validator from epoch + 1 to epoch + 2, as a
+        # dict. balances missing from the prefetched window are read with a
+        # single query for all of the validators
+        deltas = {}
+        missing = set(val_indices)
+        w = self._prefetched(epoch)
+        if w is not None:
+            for val_index in val_indices:
+                before = w['balances'].get((val_index, epoch + 1))
+                after = w['balances'].get((val_index, epoch + 2))
+                if before is not None and after is not None:
+                    deltas[val_index] = after - before
+                    missing.discard(val_index)
+        if not missing:
+            return deltas
+
+        rows = self._query(
+            'proposer_balances',
+            self.source.balances,
+            sorted(missing),
+            epoch + 1,
+            epoch + 2
+        )
+        balances = {(r[0], r[1]): r[2] for r in rows}
+        for val_index in missing:
+            deltas[val_index] = balances[(val_index, epoch + 2)] \
+                - balances[(val_index, epoch + 1)]
+        return deltas
 
     def insert_epoch_extras(self, epoch):
-        params = []
-        for v in self.validators:
-            if epoch >= v['activation_epoch'] and epoch < v['exit_epoch']:
-                params.append((
-                    epoch,
-                    v['index'],
-                    v['attestation_slot'],
-                    v['attestation_reward'],
-                    v['max_attestation_reward'],
-                    v['shortfall_missed'],
-                    v['shortfall_target'],
-                    v['shortfall_head'],
-                    v['shortfall_delay'],
-                    v['block_reward'],
-                    v['missed_block_reward']
-                ))
+        with self.metrics.stage('insert'):
+            self.writer.add(epoch, self.validators.epoch_extras_rows(epoch))
+        self.epoch = epoch
 
-        try:
-            execute_values(self.cursor, INSERT_QUERY, params)
-        except KeyboardInterrupt:
-            print(f"interrupted during processing for epoch {epoch}")
-            self.cursor.execute(DELETE_QUERY % epoch)
-            sys.exit(0)
+    def flush(self):
+        with self.metrics.stage('insert'):
+            self.writer.flush()
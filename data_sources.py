@@ -0,0 +1,1112 @@
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+
+import numpy as np
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+
+from extras_writer import EXTRAS_TABLE, EpochExtrasWriter
+from validator_store import FUTURE_EPOCH_SENTINEL, PUBKEY_LENGTH
+
+FETCH_SIZE = 100000
+
+EPOCH_EXTRAS_TABLE = 't_epoch_extras'
+
+# subset of the chaind schema read by the reward scripts
+
+SCHEMA = {
+    't_validators': (
+        "f_public_key bytea NOT NULL, "
+        "f_index bigint NOT NULL, "
+        "f_slashed boolean NOT NULL, "
+        "f_activation_eligibility_epoch bigint, "
+        "f_activation_epoch bigint, "
+        "f_exit_epoch bigint, "
+        "f_withdrawable_epoch bigint, "
+        "f_effective_balance bigint NOT NULL"
+    ),
+    't_validator_balances': (
+        "f_validator_index bigint NOT NULL, "
+        "f_epoch bigint NOT NULL, "
+        "f_balance bigint NOT NULL, "
+        "f_effective_balance bigint NOT NULL"
+    ),
+    't_beacon_committees': (
+        "f_slot bigint NOT NULL, "
+        "f_index bigint NOT NULL, "
+        "f_committee bigint[] NOT NULL"
+    ),
+    't_proposer_duties': (
+        "f_slot bigint NOT NULL, "
+        "f_validator_index bigint NOT NULL"
+    ),
+    't_blocks': (
+        "f_slot bigint NOT NULL, "
+        "f_proposer_index bigint NOT NULL, "
+        "f_root bytea NOT NULL, "
+        "f_canonical boolean"
+    ),
+    't_epoch_summaries': (
+        "f_epoch bigint NOT NULL, "
+        "f_activation_queue_length bigint NOT NULL, "
+        "f_activating_validators bigint NOT NULL, "
+        "f_active_validators bigint NOT NULL, "
+        "f_active_real_balance bigint NOT NULL, "
+        "f_active_balance bigint NOT NULL, "
+        "f_attesting_validators bigint NOT NULL, "
+        "f_attesting_balance bigint NOT NULL, "
+        "f_target_correct_validators bigint NOT NULL, "
+        "f_target_correct_balance bigint NOT NULL, "
+        "f_head_correct_validators bigint NOT NULL, "
+        "f_head_correct_balance bigint NOT NULL"
+    ),
+    't_validator_epoch_summaries': (
+        "f_validator_index bigint NOT NULL, "
+        "f_epoch bigint NOT NULL, "
+        "f_proposer_duties integer NOT NULL, "
+        "f_proposals_included integer NOT NULL, "
+        "f_attestation_included boolean NOT NULL, "
+        "f_attestation_target_correct boolean, "
+        "f_attestation_head_correct boolean, "
+        "f_attestation_inclusion_delay integer"
+    ),
+    't_deposits': (
+        "f_inclusion_slot bigint NOT NULL, "
+        "f_validator_pubkey bytea NOT NULL, "
+        "f_amount bigint NOT NULL"
+    ),
+    't_proposer_slashings': (
+        "f_inclusion_slot bigint NOT NULL, "
+        "f_inclusion_index bigint NOT NULL"
+    ),
+    't_attester_slashings': (
+        "f_inclusion_slot bigint NOT NULL, "
+        "f_inclusion_index bigint NOT NULL"
+    )
+}
+
+# tables with one partition per range of epochs; the rest are written once
+
+EPOCH_TABLES = [
+    't_validator_balances',
+    't_beacon_committees',
+    't_proposer_duties',
+    't_blocks',
+    't_epoch_summaries',
+    't_validator_epoch_summaries'
+]
+
+# postgres queries, with all values passed as query parameters
+
+LATEST_BLOCK_QUERY = "SELECT MAX(f_slot) FROM t_blocks WHERE f_canonical"
+
+CHAIN_HEAD_QUERY = (
+    "SELECT f_slot, f_root FROM t_blocks WHERE f_canonical "
+    "ORDER BY f_slot DESC LIMIT 1"
+)
+
+LATEST_SUMMARY_EPOCH_QUERY = "SELECT MAX(f_epoch) FROM t_epoch_summaries"
+
+LATEST_BALANCE_EPOCH_QUERY = "SELECT MAX(f_epoch) FROM t_validator_balances"
+
+VALIDATORS_QUERY = (
+    "SELECT f_index, f_activation_epoch, f_exit_epoch, f_slashed, f_public_key "
+    "FROM t_validators ORDER BY f_index"
+)
+
+EPOCH_SUMMARIES_QUERY = (
+    "SELECT f_epoch, f_active_balance, f_attesting_balance, "
+    "    f_target_correct_balance, f_head_correct_balance "
+    "FROM t_epoch_summaries WHERE f_epoch BETWEEN %s AND %s ORDER BY f_epoch"
+)
+
+BLOCKS_QUERY = (
+    "SELECT f_slot FROM t_blocks WHERE f_slot BETWEEN %s AND %s AND f_canonical"
+)
+
+BLOCKS_SCAN_QUERY = BLOCKS_QUERY + " ORDER BY f_slot"
+
+COMMITTEES_QUERY = (
+    "SELECT f_slot, f_committee FROM t_beacon_committees "
+    "WHERE f_slot BETWEEN %s AND %s ORDER BY f_slot, f_index"
+)
+
+PROPOSER_DUTIES_QUERY = (
+    "SELECT f_slot, f_validator_index FROM t_proposer_duties "
+    "WHERE f_slot BETWEEN %s AND %s ORDER BY f_slot"
+)
+
+BALANCES_QUERY = (
+    "SELECT f_validator_index, f_epoch, f_balance FROM t_validator_balances "
+    "WHERE f_validator_index = ANY(%s) AND f_epoch BETWEEN %s AND %s"
+)
+
+EPOCH_BALANCES_QUERY = (
+    "SELECT f_validator_index, {} FROM t_validator_balances "
+    "WHERE f_epoch = %s ORDER BY f_validator_index"
+)
+
+VALIDATOR_EPOCH_SUMMARIES_QUERY = (
+    "SELECT f_validator_index, f_proposer_duties, f_proposals_included, "
+    "    f_attestation_included, f_attestation_target_correct, "
+    "    f_attestation_head_correct, f_attestation_inclusion_delay "
+    "FROM t_validator_epoch_summaries WHERE f_epoch = %s"
+)
+
+IMPAIRED_BALANCES_QUERY = (
+    "SELECT f_epoch, f_validator_index, f_effective_balance "
+    "FROM t_validator_balances "
+    "WHERE f_epoch BETWEEN %s AND %s AND f_effective_balance <> %s "
+    "ORDER BY f_epoch, f_validator_index"
+)
+
+SLASHED_QUERY = "SELECT f_index FROM t_validators WHERE f_slashed"
+
+# the proposer of the block including a slashing receives the whistleblower
+# reward, so slashers are found by joining each slashing to its slot's duty
+
+SLASHERS_QUERY = (
+    "SELECT DISTINCT d.f_validator_index FROM ("
+    "    SELECT f_inclusion_slot FROM t_proposer_slashings "
+    "    UNION ALL "
+    "    SELECT f_inclusion_slot FROM t_attester_slashings"
+    ") s JOIN t_proposer_duties d ON d.f_slot = s.f_inclusion_slot"
+)
+
+# deposits made to already active validators. NB chaind balances are based
+# on the state *after* processing slot 0, so a deposit shows in the balance
+# of epoch (slot - 1) // 32 + 1
+
+REPEAT_DEPOSITS_QUERY = (
+    "SELECT v.f_index, (d.f_inclusion_slot - 1) / 32 + 1, d.f_amount "
+    "FROM t_deposits d "
+    "JOIN t_validators v ON v.f_public_key = d.f_validator_pubkey "
+    "WHERE d.f_inclusion_slot / 32 > v.f_activation_epoch "
+    "AND (v.f_exit_epoch IS NULL OR d.f_inclusion_slot / 32 < v.f_exit_epoch)"
+)
+
+# digest of an epoch's canonical blocks and epoch summary, which change when
+# chaind reorganises the chain
+
+EPOCH_FINGERPRINTS_QUERY = (
+    "SELECT e, md5(COALESCE(b.blocks, '') || '/' || COALESCE(s.summary, '')) "
+    "FROM generate_series(%(start)s::bigint, %(end)s::bigint) e "
+    "LEFT JOIN ("
+    "    SELECT f_slot / 32 AS f_epoch, string_agg("
+    "        f_slot || ':' || encode(f_root, 'hex'), ',' ORDER BY f_slot"
+    "    ) AS blocks "
+    "    FROM t_blocks WHERE f_canonical "
+    "    AND f_slot BETWEEN %(start)s * 32 AND %(end)s * 32 + 31 "
+    "    GROUP BY 1"
+    ") b ON b.f_epoch = e "
+    "LEFT JOIN ("
+    "    SELECT f_epoch, concat_ws(',', f_active_balance, f_attesting_balance, "
+    "        f_target_correct_balance, f_head_correct_balance) AS summary "
+    "    FROM t_epoch_summaries WHERE f_epoch BETWEEN %(start)s AND %(end)s"
+    ") s ON s.f_epoch = e "
+    "ORDER BY e"
+)
+
+DROP_EXTRAS_TABLES_QUERY = (
+    "DROP TABLE IF EXISTS t_validator_epoch_extras, "
+    "    t_validator_epoch_extras_deltas"
+)
+
+CREATE_EXTRAS_TABLE_QUERY = (
+    "CREATE TABLE IF NOT EXISTS t_validator_epoch_extras ("
+    "    f_epoch bigint NOT NULL, "
+    "    f_validator_index bigint NOT NULL, "
+    "    f_attestation_slot bigint, "
+    "    f_attestation_reward bigint , "
+    "    f_max_attestation_reward bigint, "
+    "    f_shortfall_missed bigint, "
+    "    f_shortfall_target bigint, "
+    "    f_shortfall_head bigint, "
+    "    f_shortfall_delay bigint, "
+    "    f_block_reward bigint, "
+    "    f_missed_block_reward bigint, "
+    "    CONSTRAINT i_validator_epoch_extras_1 "
+    "    PRIMARY KEY (f_validator_index, f_epoch) "
+    ")"
+)
+
+CREATE_EXTRAS_INDEX_QUERY = (
+    "CREATE INDEX IF NOT EXISTS i_validator_epoch_extras_2 "
+    "ON t_validator_epoch_extras (f_epoch)"
+)
+
+# in sparse storage mode only checkpoint epochs are stored in full, and other
+# epochs are stored as the change since the previous epoch
+
+CREATE_DELTAS_TABLE_QUERY = (
+    "CREATE TABLE IF NOT EXISTS t_validator_epoch_extras_deltas ("
+    "    f_epoch integer NOT NULL, "
+    "    f_validator_index integer NOT NULL, "
+    "    f_attestation_slot_offset smallint, "
+    "    f_attestation_reward integer, "
+    "    f_max_attestation_reward integer, "
+    "    f_shortfall_missed integer, "
+    "    f_shortfall_target integer, "
+    "    f_shortfall_head integer, "
+    "    f_shortfall_delay integer, "
+    "    f_block_reward bigint, "
+    "    f_missed_block_reward bigint, "
+    "    CONSTRAINT i_validator_epoch_extras_deltas_1 "
+    "    PRIMARY KEY (f_epoch, f_validator_index) "
+    ")"
+)
+
+ROLLBACK_EXTRAS_QUERIES = (
+    "DELETE FROM t_validator_epoch_extras WHERE f_epoch >= %s",
+    "DELETE FROM t_validator_epoch_extras_deltas WHERE f_epoch >= %s"
+)
+
+LATEST_EXTRAS_EPOCH_QUERY = (
+    "SELECT GREATEST("
+    "    (SELECT MAX(f_epoch) FROM t_validator_epoch_extras), "
+    "    (SELECT MAX(f_epoch) FROM t_validator_epoch_extras_deltas))"
+)
+
+CHECKPOINT_EPOCH_QUERY = (
+    "SELECT MAX(f_epoch) FROM t_validator_epoch_extras WHERE f_epoch <= %s"
+)
+
+EXTRAS_SUMS = (
+    "SUM(f_attestation_reward)::bigint, SUM(f_max_attestation_reward)::bigint, "
+    "SUM(f_shortfall_missed)::bigint, SUM(f_shortfall_target)::bigint, "
+    "SUM(f_shortfall_head)::bigint, SUM(f_shortfall_delay)::bigint, "
+    "SUM(f_block_reward)::bigint, SUM(f_missed_block_reward)::bigint"
+)
+
+EXTRAS_VALUES = (
+    "f_attestation_reward, f_max_attestation_reward, f_shortfall_missed, "
+    "f_shortfall_target, f_shortfall_head, f_shortfall_delay, f_block_reward, "
+    "f_missed_block_reward"
+)
+
+# optional filter on a list of validators (null for all validators)
+
+VALIDATOR_FILTER = (
+    "(%(indices)s::bigint[] IS NULL "
+    "OR f_validator_index = ANY(%(indices)s::bigint[]))"
+)
+
+CUMULATIVE_EXTRAS_QUERY = (
+    "SELECT %(epoch)s, f_validator_index, "
+    "    COALESCE("
+    "        MAX(f_attestation_slot) FILTER (WHERE f_epoch = %(epoch)s), -1"
+    "    ), "
+    "    " + EXTRAS_SUMS + " "
+    "FROM ("
+    "    SELECT f_epoch, f_validator_index, f_attestation_slot, "
+    "        " + EXTRAS_VALUES + " "
+    "    FROM t_validator_epoch_extras WHERE f_epoch = %(checkpoint)s "
+    "    UNION ALL "
+    "    SELECT f_epoch, f_validator_index, "
+    "        f_epoch * 32 + f_attestation_slot_offset, " + EXTRAS_VALUES + " "
+    "    FROM t_validator_epoch_extras_deltas "
+    "    WHERE f_epoch > %(checkpoint)s AND f_epoch <= %(epoch)s"
+    ") r WHERE " + VALIDATOR_FILTER + " "
+    "GROUP BY f_validator_index HAVING bool_or(f_epoch = %(epoch)s) "
+    "ORDER BY f_validator_index"
+)
+
+EXTRAS_RANGE_QUERY = (
+    "SELECT f_epoch, f_validator_index, COALESCE(f_attestation_slot, -1), "
+    "    " + EXTRAS_VALUES + " "
+    "FROM t_validator_epoch_extras "
+    "WHERE f_epoch BETWEEN %(start)s AND %(end)s AND " + VALIDATOR_FILTER + " "
+    "ORDER BY f_epoch, f_validator_index"
+)
+
+DELTAS_RANGE_QUERY = (
+    "SELECT f_epoch, f_validator_index, "
+    "    COALESCE(f_attestation_slot_offset, -1), "
+    "    " + EXTRAS_VALUES + " "
+    "FROM t_validator_epoch_extras_deltas "
+    "WHERE f_epoch > %(start)s AND f_epoch <= %(end)s "
+    "AND " + VALIDATOR_FILTER + " "
+    "ORDER BY f_epoch, f_validator_index"
+)
+
+DROP_EPOCH_EXTRAS_TABLE_QUERY = "DROP TABLE IF EXISTS t_epoch_extras"
+
+CREATE_EPOCH_EXTRAS_TABLE_QUERY = (
+    "CREATE TABLE IF NOT EXISTS t_epoch_extras ("
+    "    f_epoch bigint NOT NULL PRIMARY KEY, "
+    "    f_aggregate_net_reward bigint, "
+    "    f_aggregate_net_reward_nonslashed bigint, "
+    "    f_active_balance_nonslashed bigint"
+    ")"
+)
+
+LATEST_EPOCH_EXTRAS_EPOCH_QUERY = "SELECT MAX(f_epoch) FROM t_epoch_extras"
+
+EPOCH_EXTRAS_QUERY = (
+    "SELECT * FROM t_epoch_extras WHERE f_epoch BETWEEN %s AND %s "
+    "ORDER BY f_epoch"
+)
+
+INSERT_EPOCH_EXTRAS_QUERY = "INSERT INTO t_epoch_extras VALUES %s"
+
+ROLLBACK_EPOCH_EXTRAS_QUERY = "DELETE FROM t_epoch_extras WHERE f_epoch >= %s"
+
+# columns of the tables written by the reward scripts
+
+EXTRAS_COLUMNS = [
+    'f_epoch',
+    'f_validator_index',
+    'f_attestation_slot',
+    'f_attestation_reward',
+    'f_max_attestation_reward',
+    'f_shortfall_missed',
+    'f_shortfall_target',
+    'f_shortfall_head',
+    'f_shortfall_delay',
+    'f_block_reward',
+    'f_missed_block_reward'
+]
+
+EPOCH_EXTRAS_COLUMNS = [
+    'f_epoch',
+    'f_aggregate_net_reward',
+    'f_aggregate_net_reward_nonslashed',
+    'f_active_balance_nonslashed'
+]
+
+def _split_by_epoch(rows):
+    if not len(rows):
+        return {}
+    epochs, starts = np.unique(rows[:, 0], return_index=True)
+    return dict(zip(epochs.tolist(), np.split(rows, starts[1:])))
+
+def _epoch_column(values):
+    # nullable epochs as int64, with FUTURE_EPOCH_SENTINEL for null
+    return np.array(
+        [FUTURE_EPOCH_SENTINEL if v is None else v for v in values],
+        dtype=np.int64
+    )
+
+def _summary_arrays(index, duties, proposals, included, target, head, delay):
+    return {
+        'index': np.asarray(index, dtype=np.int64),
+        'proposer_duties': np.asarray(duties, dtype=np.int64),
+        'proposals_included': np.asarray(proposals, dtype=np.int64),
+        'attestation_included': np.asarray(included, dtype=bool),
+        'target_correct': np.asarray(target, dtype=bool),
+        'head_correct': np.asarray(head, dtype=bool),
+        'inclusion_delay': np.asarray(delay, dtype=np.int64)
+    }
+
+class PostgresSource:
+    # chaind tables in PostgreSQL. queries are parameterized and run on
+    # connections from a pool shared by the threads of a process; worker
+    # processes create their own source from (type(source), source.options)
+
+    def __init__(
+        self,
+        dsn=None,
+        user='chain',
+        host='127.0.0.1',
+        database='chain',
+        password='medalla',
+        max_connections=8
+    ):
+        self.options = dict(
+            dsn=dsn,
+            user=user,
+            host=host,
+            database=database,
+            password=password,
+            max_connections=max_connections
+        )
+        if dsn is not None:
+            params = {'dsn': dsn}
+        else:
+            params = dict(
+                user=user, host=host, database=database, password=password
+            )
+        self.pool = ThreadedConnectionPool(1, max_connections, **params)
+        self.key = repr(sorted(params.items()))
+
+    def close(self):
+        self.pool.closeall()
+
+    def cache_path(self, name):
+        return os.path.join('tmp', name)
+
+    @contextmanager
+    def connection(self, autocommit=True):
+        # a connection from the pool, returned to the pool afterwards
+        connection = self.pool.getconn()
+        try:
+            connection.autocommit = autocommit
+            yield connection
+        finally:
+            if not autocommit:
+                connection.rollback()
+            self.pool.putconn(connection)
+
+    def fetchall(self, query, params=None):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+
+    def _value(self, query, params=None):
+        return self.fetchall(query, params)[0][0]
+
+    def _stream(self, query, params):
+        # rows of a query as int64 arrays of up to FETCH_SIZE rows, through a
+        # server-side cursor
+        with self.connection() as connection:
+            with connection.cursor('stream', withhold=True) as cursor:
+                cursor.itersize = FETCH_SIZE
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    yield np.array(rows, dtype=np.int64)
+
+    # chain data
+
+    def latest_block(self):
+        return self._value(LATEST_BLOCK_QUERY)
+
+    def chain_head(self):
+        # (slot, root) of the latest canonical block
+        rows = self.fetchall(CHAIN_HEAD_QUERY)
+        return (rows[0][0], bytes(rows[0][1]).hex()) if rows else None
+
+    def latest_summary_epoch(self):
+        return self._value(LATEST_SUMMARY_EPOCH_QUERY)
+
+    def latest_balance_epoch(self):
+        return self._value(LATEST_BALANCE_EPOCH_QUERY)
+
+    def validators(self):
+        # columns of t_validators, ordered by index
+        rows = self.fetchall(VALIDATORS_QUERY)
+        _, activation, exit, slashed, pubkeys = zip(*rows) if rows \
+            else [()] * 5
+        return {
+            'activation_epoch': _epoch_column(activation),
+            'exit_epoch': _epoch_column(exit),
+            'slashed': np.array(slashed, dtype=bool),
+            'pubkeys': np.frombuffer(
+                b''.join(bytes(k) for k in pubkeys), dtype=np.uint8
+            ).reshape(-1, PUBKEY_LENGTH)
+        }
+
+    def epoch_summaries(self, start, end):
+        # rows of (epoch, active, attesting, target, head balance)
+        return self.fetchall(EPOCH_SUMMARIES_QUERY, (start, end))
+
+    def canonical_slots(self, start, end):
+        return [r[0] for r in self.fetchall(BLOCKS_QUERY, (start, end))]
+
+    def canonical_slot_chunks(self, start, end):
+        # canonical block slots as ordered int64 arrays, in chunks
+        for rows in self._stream(BLOCKS_SCAN_QUERY, (start, end)):
+            yield rows[:, 0]
+
+    def committees(self, start, end):
+        # rows of (slot, committee) ordered by slot and committee index
+        return self.fetchall(COMMITTEES_QUERY, (start, end))
+
+    def epoch_fingerprints(self, start, end):
+        # 16 byte digest of the chain data of each epoch in [start, end]
+        rows = self.fetchall(
+            EPOCH_FINGERPRINTS_QUERY, {'start': start, 'end': end}
+        )
+        return np.frombuffer(
+            b''.join(bytes.fromhex(r[1]) for r in rows), dtype=np.uint8
+        ).reshape(-1, 16)
+
+    def proposer_duties(self, start, end):
+        # rows of (slot, validator index) ordered by slot
+        return self.fetchall(PROPOSER_DUTIES_QUERY, (start, end))
+
+    def balances(self, validator_indices, start, end):
+        # rows of (validator index, epoch, balance)
+        indices = [int(i) for i in validator_indices]
+        return self.fetchall(BALANCES_QUERY, (indices, start, end))
+
+    def epoch_balances(self, epoch, column='f_balance'):
+        # (validator index, value) int64 arrays for one epoch of the balance
+        # or effective balance column, in chunks
+        assert column in ('f_balance', 'f_effective_balance')
+        query = sql.SQL(EPOCH_BALANCES_QUERY).format(sql.Identifier(column))
+        for rows in self._stream(query, (epoch,)):
+            yield rows[:, 0], rows[:, 1]
+
+    def validator_epoch_summaries(self, epoch):
+        # t_validator_epoch_summaries for the epoch as arrays (delay is 0
+        # where null)
+        rows = self.fetchall(VALIDATOR_EPOCH_SUMMARIES_QUERY, (epoch,))
+        if not rows:
+            return _summary_arrays(*[[]] * 7)
+        columns = list(zip(*rows))
+        columns[6] = [0 if d is None else d for d in columns[6]]
+        return _summary_arrays(*columns)
+
+    def impaired_effective_balances(self, start, end, max_effective_balance):
+        # (epoch, validator index, effective balance) int64 arrays, ordered
+        # by epoch and validator, for effective balances below the maximum
+        params = (start, end, max_effective_balance)
+        return self._stream(IMPAIRED_BALANCES_QUERY, params)
+
+    def slashed_validators(self):
+        rows = self.fetchall(SLASHED_QUERY)
+        return np.unique(np.array(rows, dtype=np.int64).ravel())
+
+    def slashers(self):
+        rows = self.fetchall(SLASHERS_QUERY)
+        return np.unique(np.array(rows, dtype=np.int64).ravel())
+
+    def repeat_deposits(self):
+        # (validator index, balance epoch, amount) of each deposit made to an
+        # already active validator
+        rows = self.fetchall(REPEAT_DEPOSITS_QUERY)
+        return np.array(rows, dtype=np.int64).reshape(-1, 3)
+
+    # validator epoch extras
+
+    def create_extras_tables(self, reset=False):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                if reset:
+                    cursor.execute(DROP_EXTRAS_TABLES_QUERY)
+                cursor.execute(CREATE_EXTRAS_TABLE_QUERY)
+                cursor.execute(CREATE_EXTRAS_INDEX_QUERY)
+                cursor.execute(CREATE_DELTAS_TABLE_QUERY)
+
+    def latest_extras_epoch(self):
+        return self._value(LATEST_EXTRAS_EPOCH_QUERY)
+
+    def rollback_extras(self, epoch):
+        # delete the extras of epochs from epoch on, in one transaction
+        with self.connection(autocommit=False) as connection:
+            with connection.cursor() as cursor:
+                for query in ROLLBACK_EXTRAS_QUERIES:
+                    cursor.execute(query, (epoch,))
+            connection.commit()
+
+    def _checkpoint(self, epoch):
+        checkpoint = self._value(CHECKPOINT_EPOCH_QUERY, (epoch,))
+        return -1 if checkpoint is None else checkpoint
+
+    def validator_epoch_extras(self, epoch, validator_indices=None):
+        # cumulative t_validator_epoch_extras rows for the epoch (optionally
+        # for the given validators only) as a 2D int64 array, with -1 for a
+        # null attestation slot. works for both full and sparse (checkpoint
+        # + delta) storage, summing the deltas since the last checkpoint in
+        # the database
+        rows = self.fetchall(CUMULATIVE_EXTRAS_QUERY, {
+            'epoch': epoch,
+            'checkpoint': self._checkpoint(epoch),
+            'indices': _index_list(validator_indices)
+        })
+        return np.array(rows, dtype=np.int64).reshape(-1, 11)
+
+    def validator_epoch_extras_range(self, start, end, validator_indices=None):
+        # cumulative t_validator_epoch_extras rows for every epoch in
+        # [start, end], as a dict of epoch -> 2D int64 array
+        checkpoint = self._checkpoint(start)
+        params = {
+            'start': checkpoint,
+            'end': end,
+            'indices': _index_list(validator_indices)
+        }
+        full = self.fetchall(EXTRAS_RANGE_QUERY, params)
+        full = np.array(full, dtype=np.int64).reshape(-1, 11)
+        deltas = self.fetchall(DELTAS_RANGE_QUERY, params)
+        deltas = np.array(deltas, dtype=np.int64).reshape(-1, 11)
+
+        n = int(max(full[:, 1].max(initial=-1), deltas[:, 1].max(initial=-1)))
+        cumulative = np.zeros((n + 1, 8), dtype=np.int64)
+        full, deltas = _split_by_epoch(full), _split_by_epoch(deltas)
+        result = {}
+        for epoch in range(checkpoint, end + 1):
+            if epoch in full:
+                rows = full[epoch]
+                cumulative[rows[:, 1]] = rows[:, 3:]
+            elif epoch in deltas:
+                rows = deltas[epoch].copy()
+                cumulative[rows[:, 1]] += rows[:, 3:]
+                rows[:, 2] = np.where(
+                    rows[:, 2] == -1, -1, rows[:, 2] + epoch * 32
+                )
+                rows[:, 3:] = cumulative[rows[:, 1]]
+            else:
+                continue
+            if epoch >= start:
+                result[epoch] = rows
+        return result
+
+    def extras_writer(
+        self, batch_size=1, binary=True, checkpoint_interval=0, metrics=None
+    ):
+        # COPY writer holding a pool connection until it is closed
+        connection = self.pool.getconn()
+        return EpochExtrasWriter(
+            connection,
+            batch_size,
+            binary,
+            checkpoint_interval,
+            metrics,
+            release=self.pool.putconn
+        )
+
+    # aggregate epoch extras
+
+    def create_epoch_extras_table(self, reset=False):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                if reset:
+                    cursor.execute(DROP_EPOCH_EXTRAS_TABLE_QUERY)
+                cursor.execute(CREATE_EPOCH_EXTRAS_TABLE_QUERY)
+
+    def latest_epoch_extras_epoch(self):
+        return self._value(LATEST_EPOCH_EXTRAS_EPOCH_QUERY)
+
+    def epoch_extras(self, start, end):
+        # t_epoch_extras rows of epochs [start, end] as a 2D int64 array
+        rows = self.fetchall(EPOCH_EXTRAS_QUERY, (start, end))
+        return np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+    def rollback_epoch_extras(self, epoch):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(ROLLBACK_EPOCH_EXTRAS_QUERY, (epoch,))
+
+    def insert_epoch_extras(self, rows):
+        # insert (epoch, net reward, nonslashed net reward, nonslashed active
+        # balance) rows in one transaction
+        with self.connection(autocommit=False) as connection:
+            with connection.cursor() as cursor:
+                execute_values(cursor, INSERT_EPOCH_EXTRAS_QUERY, rows)
+            connection.commit()
+
+def _index_list(validator_indices):
+    if validator_indices is None:
+        return None
+    return [int(i) for i in validator_indices]
+
+class FileSource:
+    # chaind tables stored as .npy column files, as written by
+    # synthetic_chain.save or a snapshot:
+    #
+    #   <directory>/<table>/<first epoch>/<column>.npy  per-epoch tables
+    #   <directory>/<table>/all/<column>.npy            other tables
+    #
+    # each partition holds the rows from its first epoch up to the next
+    # partition, sorted by f_epoch or f_slot, so ranges are found by binary
+    # search and read from memory-mapped files without copying. committees
+    # are stored as one row per member (f_slot, f_index, f_validator_index),
+    # bytea columns as 2D uint8 arrays and null values as -1. the reward
+    # scripts' own tables are written to the same directory in the same
+    # layout (always in full, without checkpoints and deltas)
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.options = dict(directory=self.directory)
+        self.key = self.directory
+        self._arrays = {}
+
+    def close(self):
+        self._arrays = {}
+
+    def cache_path(self, name):
+        return os.path.join(self.directory, 'cache', name)
+
+    def _partitions(self, table):
+        # sorted (first epoch, path) of the table's epoch partitions
+        path = os.path.join(self.directory, table)
+        if not os.path.isdir(path):
+            return []
+        return sorted(
+            (int(name), os.path.join(path, name))
+            for name in os.listdir(path) if name.isdigit()
+        )
+
+    def _array(self, path, column, cache=True):
+        filename = os.path.join(path, column + '.npy')
+        if not cache:
+            return np.load(filename, mmap_mode='r')
+        if filename not in self._arrays:
+            self._arrays[filename] = np.load(filename, mmap_mode='r')
+        return self._arrays[filename]
+
+    def _static(self, table, column):
+        return self._array(os.path.join(self.directory, table, 'all'), column)
+
+    def _range(self, table, key, start, end, columns, cache=True):
+        # columns of the rows with start <= key <= end, where key is f_epoch
+        # or f_slot (32 per epoch)
+        scale = 32 if key == 'f_slot' else 1
+        parts = self._partitions(table)
+        chunks = {column: [] for column in columns}
+        for i, (first, path) in enumerate(parts):
+            following = parts[i + 1][0] if i + 1 < len(parts) else None
+            if first * scale > end or (
+                following is not None and following * scale <= start
+            ):
+                continue
+            keys = self._array(path, key, cache)
+            lo = np.searchsorted(keys, start, 'left')
+            hi = np.searchsorted(keys, end, 'right')
+            for column in columns:
+                chunks[column].append(self._array(path, column, cache)[lo:hi])
+        return {
+            column: (
+                np.zeros(0, dtype=np.int64) if not c
+                else c[0] if len(c) == 1 else np.concatenate(c)
+            ) for column, c in chunks.items()
+        }
+
+    def _last(self, table, key, cache=True):
+        # largest key in a table (None if empty)
+        for _, path in reversed(self._partitions(table)):
+            keys = self._array(path, key, cache)
+            if len(keys):
+                return int(keys[-1])
+        return None
+
+    # chain data
+
+    def _canonical_blocks(self):
+        for _, path in reversed(self._partitions('t_blocks')):
+            canonical = np.flatnonzero(self._array(path, 'f_canonical'))
+            if len(canonical):
+                i = canonical[-1]
+                root = self._array(path, 'f_root')[i]
+                return int(self._array(path, 'f_slot')[i]), bytes(root).hex()
+        return None
+
+    def latest_block(self):
+        head = self._canonical_blocks()
+        return None if head is None else head[0]
+
+    def chain_head(self):
+        return self._canonical_blocks()
+
+    def latest_summary_epoch(self):
+        return self._last('t_epoch_summaries', 'f_epoch')
+
+    def latest_balance_epoch(self):
+        return self._last('t_validator_balances', 'f_epoch')
+
+    def validators(self):
+        def epochs(column):
+            values = np.array(self._static('t_validators', column))
+            values[values < 0] = FUTURE_EPOCH_SENTINEL
+            return values
+        return {
+            'activation_epoch': epochs('f_activation_epoch'),
+            'exit_epoch': epochs('f_exit_epoch'),
+            'slashed': np.array(self._static('t_validators', 'f_slashed')),
+            'pubkeys': np.array(self._static('t_validators', 'f_public_key'))
+        }
+
+    def epoch_summaries(self, start, end):
+        columns = [
+            'f_epoch',
+            'f_active_balance',
+            'f_attesting_balance',
+            'f_target_correct_balance',
+            'f_head_correct_balance'
+        ]
+        r = self._range('t_epoch_summaries', 'f_epoch', start, end, columns)
+        return list(zip(*[r[c].tolist() for c in columns]))
+
+    def canonical_slots(self, start, end):
+        columns = ['f_slot', 'f_canonical']
+        r = self._range('t_blocks', 'f_slot', start, end, columns)
+        return r['f_slot'][r['f_canonical'].astype(bool)].tolist()
+
+    def canonical_slot_chunks(self, start, end):
+        columns = ['f_slot', 'f_canonical']
+        r = self._range('t_blocks', 'f_slot', start, end, columns)
+        yield r['f_slot'][r['f_canonical'].astype(bool)]
+
+    def epoch_fingerprints(self, start, end):
+        columns = ['f_slot', 'f_canonical', 'f_root']
+        r = self._range(
+            't_blocks', 'f_slot', start * 32, end * 32 + 31, columns
+        )
+        canonical = r['f_canonical'].astype(bool)
+        slots, roots = r['f_slot'][canonical], r['f_root'][canonical]
+        bounds = np.searchsorted(slots, np.arange(start, end + 2) * 32)
+        columns = [
+            'f_epoch',
+            'f_active_balance',
+            'f_attesting_balance',
+            'f_target_correct_balance',
+            'f_head_correct_balance'
+        ]
+        r = self._range('t_epoch_summaries', 'f_epoch', start, end, columns)
+        summaries = np.column_stack([r[c] for c in columns]).astype(np.int64)
+
+        result = np.zeros((end - start + 1, 16), dtype=np.uint8)
+        for i, epoch in enumerate(range(start, end + 1)):
+            digest = hashlib.md5()
+            digest.update(slots[bounds[i]:bounds[i + 1]].tobytes())
+            digest.update(roots[bounds[i]:bounds[i + 1]].tobytes())
+            digest.update(summaries[summaries[:, 0] == epoch].tobytes())
+            result[i] = np.frombuffer(digest.digest(), dtype=np.uint8)
+        return result
+
+    def committees(self, start, end):
+        columns = ['f_slot', 'f_index', 'f_validator_index']
+        r = self._range('t_beacon_committees', 'f_slot', start, end, columns)
+        slot, index = r['f_slot'], r['f_index']
+        if not len(slot):
+            return []
+        change = np.flatnonzero(
+            (np.diff(slot) != 0) | (np.diff(index) != 0)
+        ) + 1
+        starts = np.concatenate([[0], change])
+        return list(zip(
+            slot[starts].tolist(),
+            [m.tolist() for m in np.split(r['f_validator_index'], change)]
+        ))
+
+    def proposer_duties(self, start, end):
+        columns = ['f_slot', 'f_validator_index']
+        r = self._range('t_proposer_duties', 'f_slot', start, end, columns)
+        return list(zip(r['f_slot'].tolist(), r['f_validator_index'].tolist()))
+
+    def balances(self, validator_indices, start, end):
+        columns = ['f_validator_index', 'f_epoch', 'f_balance']
+        r = self._range('t_validator_balances', 'f_epoch', start, end, columns)
+        keep = np.isin(
+            r['f_validator_index'], np.asarray(list(validator_indices))
+        )
+        return list(zip(*[r[c][keep].tolist() for c in columns]))
+
+    def epoch_balances(self, epoch, column='f_balance'):
+        columns = ['f_validator_index', column]
+        r = self._range(
+            't_validator_balances', 'f_epoch', epoch, epoch, columns
+        )
+        yield r['f_validator_index'], r[column]
+
+    def validator_epoch_summaries(self, epoch):
+        columns = [
+            'f_validator_index',
+            'f_proposer_duties',
+            'f_proposals_included',
+            'f_attestation_included',
+            'f_attestation_target_correct',
+            'f_attestation_head_correct',
+            'f_attestation_inclusion_delay'
+        ]
+        r = self._range(
+            't_validator_epoch_summaries', 'f_epoch', epoch, epoch, columns
+        )
+        r['f_attestation_inclusion_delay'] = np.maximum(
+            r['f_attestation_inclusion_delay'], 0
+        )
+        return _summary_arrays(*[r[c] for c in columns])
+
+    def impaired_effective_balances(self, start, end, max_effective_balance):
+        for epoch in range(start, end + 1):
+            index, balance = next(
+                self.epoch_balances(epoch, 'f_effective_balance')
+            )
+            keep = balance != max_effective_balance
+            rows = np.empty((int(keep.sum()), 3), dtype=np.int64)
+            rows[:, 0] = epoch
+            rows[:, 1] = index[keep]
+            rows[:, 2] = balance[keep]
+            yield rows
+
+    def slashed_validators(self):
+        slashed = self._static('t_validators', 'f_slashed').astype(bool)
+        return np.array(self._static('t_validators', 'f_index')[slashed])
+
+    def slashers(self):
+        slashers = [
+            validator
+            for table in ('t_proposer_slashings', 't_attester_slashings')
+            for slot in self._static(table, 'f_inclusion_slot').tolist()
+            for _, validator in self.proposer_duties(slot, slot)
+        ]
+        return np.unique(np.array(slashers, dtype=np.int64))
+
+    def repeat_deposits(self):
+        validators = self.validators()
+        lookup = {
+            bytes(k): i for i, k in enumerate(validators['pubkeys'])
+        }
+        slots = self._static('t_deposits', 'f_inclusion_slot').tolist()
+        pubkeys = self._static('t_deposits', 'f_validator_pubkey')
+        amounts = self._static('t_deposits', 'f_amount').tolist()
+        deposits = []
+        for slot, pubkey, amount in zip(slots, pubkeys, amounts):
+            index = lookup.get(bytes(pubkey))
+            if index is None:
+                continue
+            epoch = slot // 32
+            if validators['activation_epoch'][index] < epoch \
+                    < validators['exit_epoch'][index]:
+                deposits.append((index, (slot - 1) // 32 + 1, amount))
+        return np.array(deposits, dtype=np.int64).reshape(-1, 3)
+
+    # validator epoch extras
+
+    def create_extras_tables(self, reset=False):
+        if reset:
+            shutil.rmtree(
+                os.path.join(self.directory, EXTRAS_TABLE), ignore_errors=True
+            )
+
+    def latest_extras_epoch(self):
+        return self._last(EXTRAS_TABLE, 'f_epoch', cache=False)
+
+    def _rollback(self, table, columns, epoch):
+        # drop the rows of epochs from epoch on, latest partitions first
+        for first, path in reversed(self._partitions(table)):
+            epochs = self._array(path, 'f_epoch', cache=False)
+            n = int(np.searchsorted(epochs, epoch))
+            if n == len(epochs):
+                break
+            if n == 0:
+                shutil.rmtree(path)
+                continue
+            writer = PartitionWriter(
+                os.path.join(self.directory, table), columns
+            )
+            writer.add(first, np.column_stack([
+                self._array(path, c, cache=False)[:n] for c in columns
+            ]).astype(np.int64))
+            writer.flush()
+
+    def rollback_extras(self, epoch):
+        self._rollback(EXTRAS_TABLE, EXTRAS_COLUMNS, epoch)
+
+    def validator_epoch_extras(self, epoch, validator_indices=None):
+        r = self._range(
+            EXTRAS_TABLE, 'f_epoch', epoch, epoch, EXTRAS_COLUMNS, cache=False
+        )
+        rows = np.column_stack([r[c] for c in EXTRAS_COLUMNS]).astype(np.int64)
+        if validator_indices is not None:
+            rows = rows[np.isin(rows[:, 1], np.asarray(validator_indices))]
+        return rows.reshape(-1, 11)
+
+    def validator_epoch_extras_range(self, start, end, validator_indices=None):
+        result = {}
+        for epoch in range(start, end + 1):
+            rows = self.validator_epoch_extras(epoch, validator_indices)
+            if len(rows):
+                result[epoch] = rows
+        return result
+
+    def extras_writer(
+        self, batch_size=1, binary=True, checkpoint_interval=0, metrics=None
+    ):
+        return PartitionWriter(
+            os.path.join(self.directory, EXTRAS_TABLE),
+            EXTRAS_COLUMNS,
+            batch_size
+        )
+
+    # aggregate epoch extras
+
+    def create_epoch_extras_table(self, reset=False):
+        if reset:
+            shutil.rmtree(
+                os.path.join(self.directory, EPOCH_EXTRAS_TABLE),
+                ignore_errors=True
+            )
+
+    def latest_epoch_extras_epoch(self):
+        return self._last(EPOCH_EXTRAS_TABLE, 'f_epoch', cache=False)
+
+    def epoch_extras(self, start, end):
+        r = self._range(
+            EPOCH_EXTRAS_TABLE, 'f_epoch', start, end, EPOCH_EXTRAS_COLUMNS,
+            cache=False
+        )
+        rows = [r[c] for c in EPOCH_EXTRAS_COLUMNS]
+        return np.column_stack(rows).astype(np.int64).reshape(-1, 4)
+
+    def rollback_epoch_extras(self, epoch):
+        self._rollback(EPOCH_EXTRAS_TABLE, EPOCH_EXTRAS_COLUMNS, epoch)
+
+    def insert_epoch_extras(self, rows):
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 4)
+        writer = PartitionWriter(
+            os.path.join(self.directory, EPOCH_EXTRAS_TABLE),
+            EPOCH_EXTRAS_COLUMNS
+        )
+        writer.add(int(rows[0, 0]), rows)
+        writer.flush()
+
+class PartitionWriter:
+    # writes epochs of int64 rows to a FileSource table, as one partition
+    # per batch of epochs. partitions are written to a temporary directory
+    # and renamed into place, so a partition is either complete or absent
+
+    def __init__(self, directory, columns, batch_size=1):
+        self.directory = directory
+        self.columns = columns
+        self.batch_size = batch_size
+        self.discard()
+
+    def set_baseline(self, cumulative):
+        pass
+
+    def add(self, epoch, rows):
+        self.epochs.append(epoch)
+        self.chunks.append(rows)
+        if len(self.epochs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.epochs:
+            return
+        rows = np.concatenate(self.chunks)
+        path = os.path.join(self.directory, str(self.epochs[0]))
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for i, column in enumerate(self.columns):
+            np.save(os.path.join(tmp_path, column + '.npy'), rows[:, i])
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self.discard()
+
+    def discard(self):
+        self.epochs = []
+        self.chunks = []
+
+    def close(self):
+        pass
+
+def open_source(data=None, dsn=None):
+    # FileSource for a data directory, otherwise the chaind database
+    if data is not None:
+        return FileSource(data)
+    return PostgresSource(dsn)
+
+def add_arguments(parser):
+    # command line options selecting the data source
+    parser.add_argument(
+        '--dsn',
+        help="libpq connection string for the chaind database (default: "
+             "user chain on 127.0.0.1)"
+    )
+    parser.add_argument(
+        '--data', metavar='DIR',
+        help="read chain data from (and write results to) .npy files in DIR "
+             "instead of the database"
+    )
+
+def from_args(args):
+    return open_source(args.data, args.dsn)
@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+
+EB_INCREMENT = int(1e9)
+MAX_EFFECTIVE_BALANCE = 32 # in units of EB_INCREMENT
+
+def load_array(path, dtype):
+    # memory-map a raw array file, which may be empty or not exist yet
+    n = os.path.getsize(path) // np.dtype(dtype).itemsize \
+        if os.path.exists(path) else 0
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(n,))
+
+class EffectiveBalanceIndex:
+    # effective balance (in ETH) of every validator at every epoch, stored as
+    # a sparse epoch x validator matrix of the balances which differ from
+    # 32 ETH. the matrix is kept in three memory-mapped files (CSR layout):
+    #
+    #   <path>.offsets  int64   row start of each epoch, plus the end
+    #   <path>.indices  uint32  validator index of each entry
+    #   <path>.values   uint8   effective balance of each entry
+    #
+    # new epochs are appended to the end of each file, so the index can be
+    # extended as the chain progresses without being rebuilt
+
+    def __init__(self, path='tmp/effective_balances'):
+        self.path = path
+        self.load()
+
+    def load(self):
+        self.offsets = load_array(self.path + '.offsets', np.int64)
+        if not len(self.offsets):
+            self.offsets = np.zeros(1, dtype=np.int64)
+        # ignore entries past the last complete epoch (e.g. after a crash)
+        end = self.offsets[-1]
+        self.indices = load_array(self.path + '.indices', np.uint32)[:end]
+        self.values = load_array(self.path + '.values', np.uint8)[:end]
+
+    @property
+    def n_epochs(self):
+        return len(self.offsets) - 1
+
+    def extend(self, source, end_epoch=None):
+        # append epochs up to end_epoch (default: latest balances in the
+        # data source) with a single ordered scan of the impaired balances
+        if end_epoch is None:
+            end_epoch = source.latest_balance_epoch()
+        start_epoch = self.n_epochs
+        if end_epoch is None or end_epoch < start_epoch:
+            return
+
+        n_entries = int(self.offsets[-1])
+        counts = np.zeros(end_epoch - start_epoch + 1, dtype=np.int64)
+
+        # drop anything written after the last complete epoch before appending
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        for suffix, length in (
+            ('.offsets', 8 * (self.n_epochs + 1)),
+            ('.indices', 4 * n_entries),
+            ('.values', n_entries)
+        ):
+            with open(self.path + suffix, 'ab'):
+                pass
+            os.truncate(self.path + suffix, length)
+
+        chunks = source.impaired_effective_balances(
+            start_epoch, end_epoch, MAX_EFFECTIVE_BALANCE * EB_INCREMENT
+        )
+        with open(self.path + '.indices', 'ab') as f_indices, \
+             open(self.path + '.values', 'ab') as f_values:
+            for rows in chunks:
+                counts += np.bincount(
+                    rows[:, 0] - start_epoch, minlength=len(counts)
+                )
+                f_indices.write(rows[:, 1].astype(np.uint32).tobytes())
+                f_values.write(
+                    (rows[:, 2] // EB_INCREMENT).astype(np.uint8).tobytes()
+                )
+
+        # offsets are written last, which marks the new epochs as complete
+        offsets = n_entries + np.cumsum(counts)
+        with open(self.path + '.offsets', 'ab') as f:
+            f.write(offsets.astype(np.int64).tobytes())
+
+        self.load()
+
+    def truncate(self, epoch):
+        # forget epochs from epoch on (e.g. after a reorg); their entries
+        # are dropped when the index is next extended
+        path = self.path + '.offsets'
+        if os.path.exists(path):
+            os.truncate(path, min(8 * (epoch + 1), os.path.getsize(path)))
+        self.load()
+
+    def get(self, epoch, n_validators):
+        # effective balances of validators 0..n-1 at the epoch, which must be
+        # indexed (extend the index first)
+        if not 0 <= epoch < self.n_epochs:
+            raise IndexError(
+                f"epoch {epoch} is not in the effective balance index "
+                f"({self.n_epochs} epochs)"
+            )
+        balances = np.full(
+            n_validators, MAX_EFFECTIVE_BALANCE, dtype=np.int64
+        )
+        start, end = self.offsets[epoch], self.offsets[epoch + 1]
+        indices = self.indices[start:end].astype(np.int64)
+        keep = indices < n_validators
+        balances[indices[keep]] = self.values[start:end][keep]
+        return balances
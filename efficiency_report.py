@@ -0,0 +1,273 @@
+import argparse
+import csv
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+import data_sources
+from fingerprints import DEPENDENT_EPOCHS, EpochFingerprints
+from validator_sets import classify_validators
+from validator_store import ACCUMULATOR_FIELDS
+
+EXCLUDE_CHOICES = ('slashed', 'slashers', 'redeposits', 'exited')
+
+# columns of the csv report, as written by the beacon chain data notebook
+
+CSV_COLUMNS = [
+    ('validator', 'index'),
+    ('efficiency', 'validator_efficiency'),
+    ('attestation_reward', 'attestation_reward'),
+    ('max_attestation_reward', 'max_attestation_reward'),
+    ('missed_attestation_shortfall', 'shortfall_missed'),
+    ('target_shortfall', 'shortfall_target'),
+    ('head_shortfall', 'shortfall_head'),
+    ('excess_delay_shortfall', 'shortfall_delay'),
+    ('proposer_reward', 'block_reward'),
+    ('missed_proposer_reward', 'missed_block_reward'),
+    ('max_reward', 'max_reward')
+]
+
+_cache = {}
+
+def select_validators(
+    source, epoch, indices=None, pubkeys=None, genesis=False, exclude=()
+):
+    # sorted int64 indices of a validator set: the given indices and/or
+    # pubkeys (hex, with or without 0x), or all validators if neither is
+    # given. genesis keeps only validators active from epoch 0, and exclude
+    # drops slashed validators, slashers, repeat deposit validators and/or
+    # validators which exited before the epoch
+    columns = source.validators()
+    n = len(columns['activation_epoch'])
+    selected = np.zeros(n, dtype=bool)
+    if indices is None and pubkeys is None:
+        selected[:] = True
+    if indices is not None:
+        indices = np.asarray(indices, dtype=np.int64)
+        selected[indices[(indices >= 0) & (indices < n)]] = True
+    if pubkeys is not None:
+        lookup = {
+            bytes(k): i for i, k in enumerate(columns['pubkeys'])
+        }
+        for pubkey in pubkeys:
+            key = bytes.fromhex(pubkey[2:] if pubkey.startswith('0x')
+                                else pubkey)
+            if key in lookup:
+                selected[lookup[key]] = True
+
+    if genesis:
+        selected &= columns['activation_epoch'] == 0
+    if 'exited' in exclude:
+        exit_epoch = columns['exit_epoch']
+        selected &= exit_epoch >= epoch
+    sets = {'slashed', 'slashers', 'redeposits'} & set(exclude)
+    if sets:
+        selected &= ~classify_validators(source).mask(
+            n,
+            slashed='slashed' in sets,
+            slashers='slashers' in sets,
+            redeposits='redeposits' in sets
+        )
+    return np.flatnonzero(selected)
+
+def _ratio(numerator, denominator):
+    # numerator / denominator as float64, nan where the denominator is 0
+    result = np.full(len(numerator), np.nan)
+    np.divide(numerator, denominator, out=result, where=denominator != 0)
+    return result
+
+def _cache_path(source, epoch, digest, chain_digest):
+    return source.cache_path(
+        os.path.join('efficiency', f'{epoch}_{digest}_{chain_digest}.npz')
+    )
+
+def _chain_digest(source, epoch):
+    # digest of the fingerprints of the chain data the epoch's extras were
+    # calculated from, which changes when they are recalculated after a
+    # reorg, by this process or another
+    fingerprints = EpochFingerprints(
+        source.cache_path('validator_epoch_extras.fingerprints')
+    )
+    digests = fingerprints.digests[:epoch + DEPENDENT_EPOCHS + 1]
+    return hashlib.sha1(digests.tobytes()).hexdigest()[:16]
+
+def clear_cache(source):
+    # drop cached reports, e.g. when the epoch extras are recalculated
+    for key in [k for k in _cache if k[0] == source.key]:
+        del _cache[key]
+    shutil.rmtree(source.cache_path('efficiency'), ignore_errors=True)
+
+def efficiency_report(source, epoch, validator_indices=None):
+    # attestation, proposal and overall efficiency, with the shortfall
+    # breakdown, of a set of validators (default: all) as of the epoch. the
+    # cumulative extras are read with one bulk query, and the result is a
+    # dict of arrays over the validators which have extras for the epoch,
+    # with nan efficiencies where no reward was available. reports are
+    # cached per (source, epoch, set, chain data digest), in memory and in
+    # the source's cache directory, and only used while the epoch's extras
+    # are stored
+    if validator_indices is None:
+        digest = 'all'
+    else:
+        validator_indices = np.unique(
+            np.asarray(validator_indices, dtype=np.int64)
+        )
+        digest = hashlib.sha1(validator_indices.tobytes()).hexdigest()[:16]
+
+    # epochs still being (re)calculated are not cached
+    latest = source.latest_extras_epoch()
+    stored = latest is not None and epoch <= latest
+    chain_digest = _chain_digest(source, epoch)
+    key = (source.key, epoch, digest, chain_digest)
+    if stored and key in _cache:
+        return _cache[key]
+    path = _cache_path(source, epoch, digest, chain_digest)
+    if stored and os.path.exists(path):
+        with np.load(path) as f:
+            report = dict(f)
+        _cache[key] = report
+        return report
+
+    report = extras_report(
+        source.validator_epoch_extras(epoch, validator_indices)
+    )
+    if stored:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **report)
+        os.replace(tmp_path, path)
+        _cache[key] = report
+    return report
+
+def extras_report(rows):
+    # efficiency report of cumulative validator epoch extras rows
+    report = {'index': rows[:, 1]}
+    for i, field in enumerate(ACCUMULATOR_FIELDS):
+        report[field] = rows[:, i + 3]
+
+    max_proposer_reward = \
+        report['block_reward'] + report['missed_block_reward']
+    report['max_reward'] = \
+        report['max_attestation_reward'] + max_proposer_reward
+    report['reward'] = report['attestation_reward'] + report['block_reward']
+    report['attestation_efficiency'] = _ratio(
+        report['attestation_reward'], report['max_attestation_reward']
+    )
+    report['proposal_efficiency'] = _ratio(
+        report['block_reward'], max_proposer_reward
+    )
+    report['validator_efficiency'] = _ratio(
+        report['reward'], report['max_reward']
+    )
+    return report
+
+def write_csv(report, path):
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in CSV_COLUMNS])
+        columns = [report[field].tolist() for _, field in CSV_COLUMNS]
+        writer.writerows(zip(*columns))
+
+def summary(report, field='validator_efficiency'):
+    # count and percentiles (in %) of an efficiency over the validators
+    # for which it is defined
+    values = 100 * report[field][np.isfinite(report[field])]
+    if not len(values):
+        return {'count': 0}
+    q = np.percentile(values, [0, 1, 25, 50, 75, 99, 100])
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'minimum': q[0],
+        '1st percentile': q[1],
+        'lower quartile': q[2],
+        'median': q[3],
+        'upper quartile': q[4],
+        '99th percentile': q[5],
+        'maximum': q[6]
+    }
+
+def _read_list(values):
+    # command line values, where @path reads one value per line from a file
+    result = []
+    for value in values:
+        if value.startswith('@'):
+            with open(value[1:]) as f:
+                result.extend(line.strip() for line in f if line.strip())
+        else:
+            result.extend(v for v in value.split(',') if v)
+    return result
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="efficiency and shortfall report for a set of validators"
+    )
+    parser.add_argument(
+        '-e', '--epoch', type=int,
+        help="report cumulative values as of this epoch (default: latest "
+             "epoch with validator epoch extras)"
+    )
+    parser.add_argument(
+        '-i', '--indices', nargs='+', metavar='INDEX',
+        help="validator indices (comma separated, or @file with one per line)"
+    )
+    parser.add_argument(
+        '-k', '--pubkeys', nargs='+', metavar='PUBKEY',
+        help="validator pubkeys in hex (comma separated, or @file)"
+    )
+    parser.add_argument(
+        '-g', '--genesis', action='store_true',
+        help="only include validators active from epoch 0"
+    )
+    parser.add_argument(
+        '-x', '--exclude', nargs='+', default=[], choices=EXCLUDE_CHOICES,
+        help="exclude slashed validators, slashers, validators receiving "
+             "repeat deposits and/or validators exited before the epoch"
+    )
+    parser.add_argument('-o', '--output', help="write the report as csv")
+    data_sources.add_arguments(parser)
+    args = parser.parse_args()
+
+    source = data_sources.from_args(args)
+    epoch = source.latest_extras_epoch() if args.epoch is None else args.epoch
+    indices = None if args.indices is None else \
+        [int(i) for i in _read_list(args.indices)]
+    pubkeys = None if args.pubkeys is None else _read_list(args.pubkeys)
+
+    selected = None
+    if indices is not None or pubkeys is not None or args.genesis \
+            or args.exclude:
+        selected = select_validators(
+            source, epoch, indices, pubkeys, args.genesis, args.exclude
+        )
+    report = efficiency_report(source, epoch, selected)
+
+    print(f"{len(report['index'])} validators at epoch {epoch}\n")
+    for field in (
+        'validator_efficiency', 'attestation_efficiency', 'proposal_efficiency'
+    ):
+        stats = summary(report, field)
+        print(f"{field.replace('_', ' ')} ({stats.pop('count')} validators):")
+        for name, value in stats.items():
+            print(f"  {name:>15} = {value:.2f}%")
+
+    shortfalls = {
+        'missed attestations': report['shortfall_missed'].sum(),
+        'incorrect head': report['shortfall_head'].sum(),
+        'incorrect target': report['shortfall_target'].sum(),
+        'excess delay': report['shortfall_delay'].sum(),
+        'missed proposals': report['missed_block_reward'].sum()
+    }
+    total = (report['max_reward'] - report['reward']).sum()
+    print(f"\ntotal shortfall {total / 1e9:.4f} ETH")
+    for name, value in shortfalls.items():
+        share = 100 * value / total if total else 0
+        print(f"  ...due to {name + ':':20} {value / 1e9:.4f} ETH "
+              f"({share:.1f}%)")
+
+    if args.output:
+        write_csv(report, args.output)
+    source.close()
@@ -0,0 +1,290 @@
+import argparse
+import os
+
+import numpy as np
+
+import data_sources
+from effective_balances import load_array
+from efficiency_report import extras_report
+from fingerprints import EpochFingerprints, first_affected_epoch
+from validator_sets import classify_validators, read_digest, write_digest
+
+# per-epoch aggregates of the chain data and of the reward scripts' results,
+# kept up to date as new epochs land, so that the notebooks and reports read
+# small arrays instead of scanning t_epoch_summaries, t_epoch_extras and
+# t_validator_epoch_extras. they are stored as memory-mapped record files in
+# the data source's cache directory:
+#
+#   epoch_aggregates.epochs         EPOCH_DTYPE, one record per epoch
+#   epoch_aggregates.distributions  DISTRIBUTION_DTYPE, one record every
+#                                   interval epochs
+#
+# epoch records are added once epoch_extras.py has stored the epoch, and
+# distributions of validator efficiency once validator_epoch_extras.py has.
+# the fingerprints recorded by each script are copied alongside, so the
+# aggregates of epochs a script has since recalculated (e.g. after a reorg)
+# are dropped and aggregated again. so are all epoch records when
+# epoch_extras.py has recalculated every epoch for changed slashed validators,
+# and all distributions when the slashed validators they exclude change
+
+EPOCH_DTYPE = np.dtype([
+    ('epoch', np.int64),
+    ('active_validators', np.int64),
+    ('active_balance', np.int64),
+    ('attesting_balance', np.int64),
+    ('target_correct_balance', np.int64),
+    ('head_correct_balance', np.int64),
+    ('aggregate_net_reward', np.int64),
+    ('aggregate_net_reward_nonslashed', np.int64),
+    ('active_balance_nonslashed', np.int64)
+])
+
+# validator efficiency (in %) of the validators which are not slashed or
+# slashers (the nonslashed validators of t_epoch_extras), as of the epoch
+
+QUANTILES = [0, 1, 25, 50, 75, 99, 100]
+QUANTILE_NAMES = [
+    'minimum',
+    '1st percentile',
+    'lower quartile',
+    'median',
+    'upper quartile',
+    '99th percentile',
+    'maximum'
+]
+HISTOGRAM_BINS = 1000 # 0.1% wide, from 0% to 100%
+
+DISTRIBUTION_DTYPE = np.dtype([
+    ('epoch', np.int64),
+    ('count', np.int64),
+    ('mean', np.float64),
+    ('quantiles', np.float64, (len(QUANTILES),)),
+    ('histogram', np.uint32, (HISTOGRAM_BINS,))
+])
+
+DISTRIBUTION_INTERVAL = 256
+
+# the fingerprints recorded by the scripts whose results are aggregated, and
+# the slashed validator digest recorded by epoch_extras.py
+
+EPOCH_EXTRAS_FINGERPRINTS = 'epoch_extras.fingerprints'
+EXTRAS_FINGERPRINTS = 'validator_epoch_extras.fingerprints'
+EPOCH_EXTRAS_SLASHED = 'epoch_extras.slashed'
+
+def _append(path, records):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'ab') as f:
+        f.write(records.tobytes())
+
+def _truncate(path, dtype, n):
+    # keep the first n records (and drop any partly written one)
+    if os.path.exists(path) and os.path.getsize(path) > n * dtype.itemsize:
+        os.truncate(path, n * dtype.itemsize)
+
+def active_validators(validators, epochs):
+    # number of validators active at each epoch
+    activation = np.sort(validators['activation_epoch'])
+    exit = np.sort(validators['exit_epoch'])
+    return np.searchsorted(activation, epochs, side='right') - \
+        np.searchsorted(exit, epochs, side='right')
+
+def participation(epochs):
+    # share of the active balance which attested, per epoch record
+    return epochs['attesting_balance'] / epochs['active_balance']
+
+def average_reward_nonslashed(epochs, effective_balance=32e9):
+    # per-epoch net reward (gwei) of a nonslashed validator with the given
+    # effective balance, per epoch record
+    return effective_balance * epochs['aggregate_net_reward_nonslashed'] \
+        / epochs['active_balance_nonslashed']
+
+def summary(distribution):
+    # count, mean and quantiles of a distribution record, as
+    # efficiency_report.summary
+    if not distribution['count']:
+        return {'count': 0}
+    result = {
+        'count': int(distribution['count']),
+        'mean': float(distribution['mean'])
+    }
+    result.update(zip(QUANTILE_NAMES, distribution['quantiles'].tolist()))
+    return result
+
+class EpochAggregates:
+    # the epoch and distribution records of a data source, read as numpy
+    # record arrays (aggregates.epochs['active_balance'] etc.)
+
+    def __init__(self, source, interval=DISTRIBUTION_INTERVAL):
+        self.path = source.cache_path('epoch_aggregates')
+        self.interval = interval
+        self.load()
+
+    def load(self):
+        self.epochs = load_array(self.path + '.epochs', EPOCH_DTYPE)
+        self.distributions = load_array(
+            self.path + '.distributions', DISTRIBUTION_DTYPE
+        )
+
+    @property
+    def n_epochs(self):
+        return len(self.epochs)
+
+    def distribution(self, epoch):
+        # the latest distribution record as of the epoch, or None
+        i = np.searchsorted(self.distributions['epoch'], epoch, side='right')
+        return self.distributions[i - 1] if i else None
+
+    def truncate(self, epoch, distribution_epoch=None):
+        # forget the epoch records from epoch on, and the distributions from
+        # distribution_epoch (default: epoch) on
+        if distribution_epoch is None:
+            distribution_epoch = epoch
+        _truncate(self.path + '.epochs', EPOCH_DTYPE, epoch)
+        _truncate(
+            self.path + '.distributions',
+            DISTRIBUTION_DTYPE,
+            int(np.searchsorted(
+                self.distributions['epoch'], distribution_epoch
+            ))
+        )
+        self.load()
+
+    def _outdated(self, source, name, latest, kind, digest):
+        # first epoch whose aggregates of a kind are out of date with a
+        # script's results (ones it has since deleted, or recalculated from
+        # changed chain data), or 0 if the slashed validator digest they were
+        # aggregated with has changed, with the recorded and current
+        # fingerprints
+        recorded = EpochFingerprints(self.path + '.' + name)
+        current = EpochFingerprints(source.cache_path(name))
+        epoch = 0 if latest is None else latest + 1
+        changed = recorded.first_difference(current)
+        if changed is not None:
+            epoch = min(epoch, first_affected_epoch(changed))
+        if read_digest(self.path + '.' + kind + '.slashed') != digest:
+            epoch = 0
+        return epoch, recorded, current
+
+    def update(self, source):
+        # drop outdated aggregates, then aggregate the epochs stored by the
+        # reward scripts since the last update
+        latest = source.latest_epoch_extras_epoch()
+        latest_extras = source.latest_extras_epoch()
+        epoch_digest = read_digest(source.cache_path(EPOCH_EXTRAS_SLASHED))
+        distribution_digest = classify_validators(source).slashed_digest()
+        epoch, *epoch_fingerprints = self._outdated(
+            source, EPOCH_EXTRAS_FINGERPRINTS, latest, 'epochs', epoch_digest
+        )
+        distribution_epoch, *distribution_fingerprints = self._outdated(
+            source, EXTRAS_FINGERPRINTS, latest_extras, 'distributions',
+            distribution_digest
+        )
+        self.truncate(epoch, distribution_epoch)
+        for (recorded, current), kind, digest in (
+            (epoch_fingerprints, 'epochs', epoch_digest),
+            (distribution_fingerprints, 'distributions', distribution_digest)
+        ):
+            recorded.copy(current)
+            write_digest(self.path + '.' + kind + '.slashed', digest or '')
+
+        if latest is None and latest_extras is None:
+            return
+        validators = source.validators()
+        if latest is not None and latest >= self.n_epochs:
+            self._extend_epochs(source, validators, latest)
+        if latest_extras is not None:
+            self._extend_distributions(source, validators, latest_extras)
+
+    def _extend_epochs(self, source, validators, end_epoch):
+        start_epoch = self.n_epochs
+        summaries = np.array(
+            source.epoch_summaries(start_epoch, end_epoch), dtype=np.int64
+        ).reshape(-1, 5)
+        extras = source.epoch_extras(start_epoch, end_epoch)
+        n = min(len(summaries), len(extras))
+        epochs = np.arange(start_epoch, start_epoch + n)
+        for name, rows in (('summary', summaries), ('extras', extras)):
+            missing = np.flatnonzero(rows[:n, 0] != epochs)
+            if len(missing):
+                raise ValueError(
+                    f"no epoch {name} for epoch {epochs[missing[0]]}"
+                )
+
+        records = np.zeros(n, dtype=EPOCH_DTYPE)
+        records['epoch'] = epochs
+        records['active_validators'] = active_validators(
+            validators, records['epoch']
+        )
+        for i, field in enumerate(EPOCH_DTYPE.names[2:6]):
+            records[field] = summaries[:n, i + 1]
+        for i, field in enumerate(EPOCH_DTYPE.names[6:]):
+            records[field] = extras[:n, i + 1]
+        _append(self.path + '.epochs', records)
+        self.load()
+
+    def _extend_distributions(self, source, validators, end_epoch):
+        excluded = classify_validators(source).mask(
+            len(validators['activation_epoch']), redeposits=False
+        )
+        start_epoch = 0
+        if len(self.distributions):
+            last = int(self.distributions['epoch'][-1])
+            start_epoch = last - last % self.interval + self.interval
+        for epoch in range(start_epoch, end_epoch + 1, self.interval):
+            report = extras_report(source.validator_epoch_extras(epoch))
+            efficiency = report['validator_efficiency'][
+                ~excluded[report['index']]
+            ]
+            values = 100 * efficiency[np.isfinite(efficiency)]
+
+            record = np.zeros(1, dtype=DISTRIBUTION_DTYPE)
+            record['epoch'] = epoch
+            record['count'] = len(values)
+            if len(values):
+                record['mean'] = values.mean()
+                record['quantiles'] = np.percentile(values, QUANTILES)
+                record['histogram'] = np.histogram(
+                    np.clip(values, 0, 100), HISTOGRAM_BINS, (0, 100)
+                )[0]
+            _append(self.path + '.distributions', record)
+        self.load()
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--distribution-interval', type=int, default=DISTRIBUTION_INTERVAL,
+        metavar='EPOCHS',
+        help="aggregate the validator efficiency distribution every EPOCHS "
+             "epochs"
+    )
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="update the per-epoch aggregates read by the notebooks"
+    )
+    add_arguments(parser)
+    data_sources.add_arguments(parser)
+    args = parser.parse_args()
+
+    source = data_sources.from_args(args)
+    aggregates = EpochAggregates(source, args.distribution_interval)
+    aggregates.update(source)
+
+    epochs = aggregates.epochs
+    print(f"{aggregates.n_epochs} epochs aggregated")
+    if len(epochs):
+        print(f"average participation rate: "
+              f"{100 * participation(epochs).mean():.1f}%")
+        print(f"average nonslashed reward: "
+              f"{average_reward_nonslashed(epochs).mean():.0f} gwei/epoch")
+        print(f"active validators at epoch {epochs['epoch'][-1]}: "
+              f"{epochs['active_validators'][-1]}")
+
+    if len(aggregates.distributions):
+        distribution = aggregates.distributions[-1]
+        stats = summary(distribution)
+        print(f"\nvalidator efficiency at epoch {distribution['epoch']} "
+              f"({stats.pop('count')} validators):")
+        for name, value in stats.items():
+            print(f"  {name:>15} = {value:.2f}%")
+    source.close()
@@ -0,0 +1,273 @@
+import io
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from instrumentation import Metrics
+
+COPY_QUERY = "COPY %s FROM STDIN"
+COPY_BINARY_QUERY = "COPY %s FROM STDIN (FORMAT binary)"
+
+EXTRAS_TABLE = 't_validator_epoch_extras'
+DELTAS_TABLE = 't_validator_epoch_extras_deltas'
+
+# byte sizes of the t_validator_epoch_extras_deltas columns: epoch, validator
+# index, attestation slot offset within the epoch, the six attestation
+# deltas and the two block reward deltas
+
+DELTA_SIZES = [4, 4, 2, 4, 4, 4, 4, 4, 4, 8, 8]
+
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_TRAILER = struct.pack('!h', -1)
+
+def rows_to_copy_text(rows, null_column=2):
+    # tab-separated COPY text for a 2D int64 array, writing \N for -1 in
+    # null_column. numpy formats the values into a zero-padded byte matrix
+    # (20 bytes fit any int64), a separator is placed after each field and
+    # the padding dropped, so there is no per-row python formatting
+    fields = rows.astype('S20')
+    fields[:, null_column][rows[:, null_column] == -1] = b'\\N'
+    chars = np.zeros(rows.shape + (21,), dtype=np.uint8)
+    chars[:, :, :20] = fields.view(np.uint8).reshape(rows.shape + (20,))
+    chars[:, :-1, 20] = ord('\t')
+    chars[:, -1, 20] = ord('\n')
+    return chars[chars != 0].tobytes().decode('ascii')
+
+def rows_to_copy_binary(rows, null_column=2, sizes=None):
+    # COPY binary tuples (without header/trailer) for a 2D int64 array,
+    # writing null for -1 in null_column. sizes gives the byte size of each
+    # column's integer type (default bigint). each tuple is a field count
+    # followed by a length and a big-endian value per field, so the rows can
+    # be packed as a structured array without a python loop
+    null = rows[:, null_column] == -1
+    n_columns = rows.shape[1]
+    sizes = [8] * n_columns if sizes is None else sizes
+    chunks = []
+    for is_null in (False, True):
+        subset = rows[null if is_null else ~null]
+        if not len(subset):
+            continue
+        fields = [('n', '>i2')]
+        for c in range(n_columns):
+            fields.append((f'l{c}', '>i4'))
+            if not (is_null and c == null_column):
+                fields.append((f'v{c}', f'>i{sizes[c]}'))
+        packed = np.empty(len(subset), dtype=fields)
+        packed['n'] = n_columns
+        for c in range(n_columns):
+            if is_null and c == null_column:
+                packed[f'l{c}'] = -1
+            else:
+                packed[f'l{c}'] = sizes[c]
+                packed[f'v{c}'] = subset[:, c]
+        chunks.append(packed.tobytes())
+    return b''.join(chunks)
+
+def delta_rows(rows, previous):
+    # t_validator_epoch_extras_deltas rows from cumulative epoch extras rows,
+    # given the previous cumulative values indexed by validator
+    index = rows[:, 1]
+    deltas = np.empty_like(rows)
+    deltas[:, :2] = rows[:, :2]
+    deltas[:, 2] = np.where(rows[:, 2] == -1, -1, rows[:, 2] - rows[:, 0] * 32)
+    deltas[:, 3:] = rows[:, 3:] - previous[index]
+    for c, size in enumerate(DELTA_SIZES):
+        limit = 2 ** (8 * size - 1)
+        if len(deltas) and not (
+            (deltas[:, c] >= -limit) & (deltas[:, c] < limit)
+        ).all():
+            raise ValueError(
+                f"epoch {rows[0, 0]} delta column {c} exceeds {size} bytes"
+            )
+    return deltas
+
+class EpochExtrasWriter:
+    # buffers t_validator_epoch_extras rows in memory and writes them with
+    # COPY, committing batch_size epochs per transaction on a dedicated
+    # (non-autocommit) connection. an epoch is therefore either written in
+    # full or not at all, and an interrupted run resumes from the last
+    # committed epoch.
+    #
+    # with a checkpoint_interval of K, only every Kth epoch is written to
+    # t_validator_epoch_extras in full; other epochs are written to
+    # t_validator_epoch_extras_deltas as the change since the previous epoch.
+    #
+    # the connection is closed by close(), or passed to release (e.g. to
+    # return it to a connection pool)
+
+    def __init__(
+        self,
+        connection,
+        batch_size=1,
+        binary=True,
+        checkpoint_interval=0,
+        metrics=None,
+        release=None
+    ):
+        self.connection = connection
+        self.release = release
+        self.connection.autocommit = False
+        self.cursor = connection.cursor()
+        self.batch_size = batch_size
+        self.binary = binary
+        self.checkpoint_interval = checkpoint_interval
+        self.metrics = Metrics() if metrics is None else metrics
+        self.previous = None
+        self.undo = []
+        self.discard()
+
+    def set_baseline(self, cumulative):
+        # cumulative values (validators x 8) as of the last written epoch
+        self.previous = cumulative.copy()
+        self.undo = []
+
+    def add(self, epoch, rows):
+        table, sizes = EXTRAS_TABLE, None
+        if self.checkpoint_interval:
+            size = None if self.previous is None else len(self.previous)
+            n = rows[:, 1].max() + 1 if len(rows) else 0
+            if self.previous is None:
+                self.previous = np.zeros((n, rows.shape[1] - 3), dtype=np.int64)
+            elif n > len(self.previous):
+                grow = np.zeros(
+                    (n - len(self.previous), self.previous.shape[1]),
+                    dtype=np.int64
+                )
+                self.previous = np.concatenate([self.previous, grow])
+
+            index, cumulative = rows[:, 1], rows[:, 3:]
+            if epoch % self.checkpoint_interval:
+                table, sizes = DELTAS_TABLE, DELTA_SIZES
+                rows = delta_rows(rows, self.previous)
+            # the values replaced, restored if the epoch is not committed
+            self.undo.append((size, index, self.previous[index]))
+            self.previous[index] = cumulative
+
+        if self.binary:
+            self.chunks[table].append(rows_to_copy_binary(rows, sizes=sizes))
+        else:
+            self.chunks[table].append(rows_to_copy_text(rows))
+        self.n_rows[table] += len(rows)
+        self.epochs.append(epoch)
+        if len(self.epochs) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # write and commit all buffered epochs in a single transaction
+        if not self.epochs:
+            return
+        try:
+            for table, chunks in self.chunks.items():
+                if not chunks:
+                    continue
+                if self.binary:
+                    buf = io.BytesIO(
+                        BINARY_HEADER + b''.join(chunks) + BINARY_TRAILER
+                    )
+                    query = COPY_BINARY_QUERY % table
+                else:
+                    buf = io.StringIO(''.join(chunks))
+                    query = COPY_QUERY % table
+                with self.metrics.query('copy'):
+                    self.cursor.copy_expert(query, buf)
+                self.metrics.rows('copy', self.n_rows[table])
+            with self.metrics.query('commit'):
+                self.connection.commit()
+            self.undo = []
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self.discard()
+
+    def discard(self):
+        # drop buffered epochs that have not been committed, restoring the
+        # cumulative values deltas are taken against to the last committed
+        # epoch
+        for size, index, values in reversed(self.undo):
+            self.previous[index] = values
+            self.previous = None if size is None else self.previous[:size]
+        self.undo = []
+        self.epochs = []
+        self.chunks = {EXTRAS_TABLE: [], DELTAS_TABLE: []}
+        self.n_rows = {EXTRAS_TABLE: 0, DELTAS_TABLE: 0}
+
+    def close(self):
+        self.cursor.close()
+        if self.release is None:
+            self.connection.close()
+        else:
+            self.connection.rollback()
+            self.release(self.connection)
+
+class BackgroundWriter:
+    # runs an EpochExtrasWriter on its own thread, fed through a bounded
+    # queue, so that epochs are serialised and copied to the database while
+    # the next epoch is calculated. calls are applied in order, add blocks
+    # while depth epochs are waiting, and an error on the writer thread is
+    # raised by every later call until discard
+
+    def __init__(self, writer, depth=4):
+        self.writer = writer
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                method, args = item
+                if self.error is None:
+                    getattr(self.writer, method)(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        # the error stays set, so that every later call raises it and the
+        # writer thread skips every call queued after the failed one (which
+        # would otherwise commit later epochs around the rolled back ones)
+        # until discard
+        if self.error is not None:
+            raise self.error
+
+    def _call(self, method, *args, wait=False):
+        self._check()
+        self.queue.put((method, args))
+        if wait:
+            self.queue.join()
+            self._check()
+
+    def set_baseline(self, cumulative):
+        self._call('set_baseline', cumulative.copy())
+
+    def add(self, epoch, rows):
+        self._call('add', epoch, rows)
+
+    def flush(self):
+        self._call('flush', wait=True)
+
+    def discard(self):
+        # drop queued epochs which have not reached the writer yet
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                break
+        self.queue.join()
+        self.error = None
+        self._call('discard', wait=True)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
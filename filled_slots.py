@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+
+from effective_balances import load_array
+
+class FilledSlotIndex:
+    # which slots of the chain have a canonical block, and the minimum
+    # inclusion delay of an attestation made at each slot (the distance to
+    # the next filled slot), kept in two memory-mapped files:
+    #
+    #   <path>.bits    uint8   filled slot flags, 8 per byte (32 per epoch)
+    #   <path>.delays  uint16  minimum inclusion delay of each slot
+    #
+    # only complete epochs are indexed. delays are only known up to the last
+    # filled slot, and are completed as the index is extended with new blocks
+
+    def __init__(self, path='tmp/filled_slots'):
+        self.path = path
+        self.load()
+
+    def load(self):
+        bits = load_array(self.path + '.bits', np.uint8)
+        self.bits = bits[:len(bits) - len(bits) % 4]
+        self.n_resolved = self._last_filled_slot()
+        self.delays = load_array(
+            self.path + '.delays', np.uint16
+        )[:self.n_resolved]
+
+    def _last_filled_slot(self):
+        # the slots before it are the ones with a known next filled slot
+        nonzero = np.flatnonzero(self.bits)
+        if not len(nonzero):
+            return 0
+        i = int(nonzero[-1])
+        return 8 * i + int(np.flatnonzero(np.unpackbits(self.bits[i]))[-1])
+
+    @property
+    def n_epochs(self):
+        return len(self.bits) // 4
+
+    def extend(self, source, end_epoch=None):
+        # append epochs up to end_epoch (default: the last epoch which cannot
+        # receive more blocks) with a single ordered scan of canonical blocks
+        if end_epoch is None:
+            latest = source.latest_block()
+            if latest is None:
+                return
+            end_epoch = (latest + 1) // 32 - 1
+        start_epoch = self.n_epochs
+        if end_epoch < start_epoch:
+            return
+
+        start_slot = start_epoch * 32
+        end_slot = end_epoch * 32 + 31
+        filled = np.zeros(end_slot - start_slot + 1, dtype=bool)
+        for slots in source.canonical_slot_chunks(start_slot, end_slot):
+            filled[slots - start_slot] = True
+
+        # delays of the slots from the previous last filled slot up to the new
+        # one, where the next filled slot is now known
+        next_filled = start_slot + np.flatnonzero(filled)
+        delays = np.zeros(0, dtype=np.uint16)
+        if len(next_filled):
+            slots = np.arange(self.n_resolved, next_filled[-1])
+            delays = (
+                next_filled[np.searchsorted(next_filled, slots + 1)] - slots
+            ).astype(np.uint16)
+
+        # drop anything written after the last complete epoch, then append
+        # the delays, and the flags last, which marks the epochs as complete
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        for suffix, length in (
+            ('.bits', len(self.bits)),
+            ('.delays', 2 * self.n_resolved)
+        ):
+            with open(self.path + suffix, 'ab'):
+                pass
+            os.truncate(self.path + suffix, length)
+        with open(self.path + '.delays', 'ab') as f:
+            f.write(delays.tobytes())
+        with open(self.path + '.bits', 'ab') as f:
+            f.write(np.packbits(filled).tobytes())
+
+        self.load()
+
+    def truncate(self, epoch):
+        # forget epochs from epoch on (e.g. after a reorg)
+        path = self.path + '.bits'
+        if os.path.exists(path):
+            os.truncate(path, min(4 * epoch, os.path.getsize(path)))
+        self.load()
+
+    def filled(self, start, end):
+        # filled flags of slots [start, end], which must be indexed
+        if not 0 <= start <= end < 8 * len(self.bits):
+            raise IndexError(
+                f"slots {start}-{end} are not in the filled slot index "
+                f"({8 * len(self.bits)} slots)"
+            )
+        flags = np.unpackbits(self.bits[start // 8:end // 8 + 1])
+        offset = start - start % 8
+        return flags[start - offset:end - offset + 1].astype(bool)
+
+    def min_inclusion_delays(self, start, end):
+        # minimum inclusion delays of slots [start, end] (0 where not yet
+        # known)
+        result = np.zeros(end - start + 1, dtype=np.int64)
+        known = self.delays[start:end + 1]
+        result[:len(known)] = known
+        return result
@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+
+from effective_balances import load_array
+
+# number of most recent recorded epochs checked for changed chain data
+REORG_DEPTH = 256
+
+# results for an epoch depend on the chain data of up to this many epochs
+# after it (balances at epoch + 2)
+DEPENDENT_EPOCHS = 2
+
+def complete_epoch(source):
+    # last epoch which has its epoch summary and cannot receive more blocks
+    latest_block = source.latest_block()
+    latest_summary = source.latest_summary_epoch()
+    if latest_block is None or latest_summary is None:
+        return None
+    return min((latest_block + 1) // 32 - 1, latest_summary)
+
+class EpochFingerprints:
+    # digests of the chain data of each epoch (its canonical blocks and
+    # epoch summary) as they were when results were calculated from them,
+    # stored as 16 bytes per epoch from epoch 0. comparing them with the
+    # current digests finds the epochs changed by a reorg, so that only the
+    # results from there on need to be recalculated
+
+    def __init__(self, path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        digests = load_array(self.path, np.uint8)
+        self.digests = digests[:len(digests) - len(digests) % 16]
+        self.digests = self.digests.reshape(-1, 16)
+
+    @property
+    def n_epochs(self):
+        return len(self.digests)
+
+    def first_change(self, source, depth=REORG_DEPTH):
+        # first of the last depth (0 for all) recorded epochs whose chain
+        # data has changed, or None
+        if not self.n_epochs:
+            return None
+        start = max(self.n_epochs - depth, 0) if depth else 0
+        current = source.epoch_fingerprints(start, self.n_epochs - 1)
+        changed = np.flatnonzero(
+            (current != self.digests[start:]).any(axis=1)
+        )
+        return start + int(changed[0]) if len(changed) else None
+
+    def first_difference(self, other):
+        # first epoch recorded in both sets of digests where they differ, or
+        # None
+        n = min(self.n_epochs, other.n_epochs)
+        changed = np.flatnonzero(
+            (self.digests[:n] != other.digests[:n]).any(axis=1)
+        )
+        return int(changed[0]) if len(changed) else None
+
+    def copy(self, other):
+        # replace the digests with those of another set
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(other.digests.tobytes())
+        os.replace(tmp_path, self.path)
+        self.load()
+
+    def truncate(self, epoch):
+        # forget the digests of epochs from epoch on
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            os.truncate(self.path, min(16 * epoch, size))
+        self.load()
+
+    def extend(self, source, end_epoch=None):
+        # record the digests of epochs up to end_epoch (default: the last
+        # complete epoch)
+        if end_epoch is None:
+            end_epoch = complete_epoch(source)
+        start_epoch = self.n_epochs
+        if end_epoch is None or end_epoch < start_epoch:
+            return
+        digests = source.epoch_fingerprints(start_epoch, end_epoch)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.truncate(start_epoch)
+        with open(self.path, 'ab') as f:
+            f.write(digests.tobytes())
+        self.load()
+
+def first_affected_epoch(changed_epoch):
+    # first epoch whose results depend on a changed epoch's chain data
+    return max(changed_epoch - DEPENDENT_EPOCHS, 0)
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--reorg-depth', type=int, default=REORG_DEPTH, metavar='EPOCHS',
+        help="recalculate results from the first of the last EPOCHS recorded "
+             "epochs whose chain data has changed since (0 checks all)"
+    )
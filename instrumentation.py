@@ -0,0 +1,194 @@
+import cProfile
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metrics:
+    # wall time and call count per named stage, plus counters (rows, round
+    # trips), for the epoch loops. database queries are recorded as stages
+    # named query:<type>, each call being one round trip. a snapshot can be
+    # appended to a JSON lines file every interval seconds and/or served as
+    # JSON over http, and an epoch range can be run under cProfile
+
+    def __init__(
+        self,
+        path=None,
+        interval=10.0,
+        port=None,
+        profile_epochs=None,
+        profile_path=None
+    ):
+        self.path = path
+        self.interval = interval
+        self.stages = {}
+        self.counters = {}
+        self.epochs = 0
+        self.epoch = None
+        self.start_time = time.time()
+        self.last_emit = self.start_time
+        self.lock = threading.Lock()
+
+        self.profile_epochs = profile_epochs
+        self.profile_path = profile_path
+        if profile_epochs is not None and profile_path is None:
+            self.profile_path = 'epochs_%d_%d.prof' % profile_epochs
+        self.profiler = None
+
+        self.server = None
+        if port is not None:
+            self.serve(port)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def query(self, name):
+        self.count('round_trips')
+        with self.stage('query:' + name):
+            yield
+
+    def rows(self, name, n):
+        self.count('rows:' + name, n)
+
+    def merge(self, snapshot):
+        # add the stages and counters of a snapshot (e.g. from a worker)
+        for name, stage in snapshot['stages'].items():
+            self.add_time(name, stage['seconds'], stage['calls'])
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+
+    def take(self):
+        # snapshot the stages and counters, and reset them
+        snapshot = self.snapshot()
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+        return snapshot
+
+    def start(self, epoch):
+        # called before the first epoch of a loop
+        self._update_profile(epoch)
+
+    def epoch_done(self, epoch):
+        self.epochs += 1
+        self.epoch = epoch
+        self._update_profile(epoch + 1)
+        if self.path is not None and \
+                time.time() - self.last_emit >= self.interval:
+            self.emit()
+
+    def _update_profile(self, next_epoch):
+        if self.profile_epochs is None:
+            return
+        start, end = self.profile_epochs
+        if self.profiler is None and start <= next_epoch < end:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profiler is not None and not start <= next_epoch < end:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+            self.profile_epochs = None
+
+    def snapshot(self):
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            return {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'epoch': self.epoch,
+                'epochs': self.epochs,
+                'elapsed': elapsed,
+                'epochs_per_second': self.epochs / elapsed if elapsed else 0,
+                'stages': {
+                    name: {'seconds': s[0], 'calls': s[1]}
+                    for name, s in self.stages.items()
+                },
+                'counters': dict(self.counters)
+            }
+
+    def emit(self):
+        # append a snapshot to the JSON lines file
+        self.last_emit = time.time()
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+
+    def serve(self, port):
+        # serve the latest snapshot as JSON on localhost:port
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+        if self.path is not None:
+            self.emit()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def epoch_range(text):
+    # argparse type for START:END (END exclusive)
+    start, end = text.split(':')
+    return int(start), int(end)
+
+def add_arguments(parser):
+    # command line options shared by the epoch loop scripts
+    parser.add_argument(
+        '--metrics', metavar='PATH',
+        help="append a JSON line of per-stage timings, row counts and round "
+             "trips to PATH every --metrics-interval seconds"
+    )
+    parser.add_argument('--metrics-interval', type=float, default=10.0)
+    parser.add_argument(
+        '--metrics-port', type=int,
+        help="serve the current metrics as JSON on localhost:PORT"
+    )
+    parser.add_argument(
+        '--profile', type=epoch_range, metavar='START:END',
+        help="run epochs START to END-1 under cProfile"
+    )
+    parser.add_argument('--profile-path')
+
+def from_args(args):
+    return Metrics(
+        path=args.metrics,
+        interval=args.metrics_interval,
+        port=args.metrics_port,
+        profile_epochs=args.profile,
+        profile_path=args.profile_path
+    )
@@ -0,0 +1,179 @@
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+from scipy.stats import binom
+
+# the annualised reward model of the validator rewards notebook, as
+# functions of arrays of validator counts, participation rates and uptimes,
+# and a monte carlo simulator of annual net rewards. rewards are in ETH per
+# validator per year, assuming all validators have an effective balance of
+# 32 ETH
+
+EPOCHS_PER_YEAR = 82180
+SLOTS_PER_YEAR = 31556952 // 12
+
+def annualised_base_reward(n):
+    return EPOCHS_PER_YEAR * 512 / np.sqrt(np.asarray(n) * 32e9)
+
+def ideal_reward(n):
+    # all validators participating perfectly
+    return 4 * annualised_base_reward(n)
+
+def annual_yield(reward):
+    # percentage return on a 32 ETH deposit
+    return 100 * np.asarray(reward) / 32
+
+def inclusion_factor(participation):
+    # expected share of the attester's inclusion reward, P ln(P) / (P - 1),
+    # which tends to 1 as P tends to 1
+    p = np.asarray(participation, dtype=np.float64)
+    result = np.ones(p.shape)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(p * np.log(p), p - 1, out=result, where=p != 1)
+    return result if result.ndim else float(result)
+
+def expected_reward(n, participation=1, uptime=1):
+    # expected net reward of a validator with the given uptime in a network
+    # with the given participation rate:
+    # R = 3BPU - 3B(1 - U) + (7/8)BPU ln(P) / (P - 1) + (1/8)BPU
+    b = annualised_base_reward(n)
+    p = np.asarray(participation)
+    u = np.asarray(uptime)
+    return b * (
+        3 * p * u
+        - 3 * (1 - u)
+        + (7 / 8) * u * inclusion_factor(p)
+        + (1 / 8) * p * u
+    )
+
+def _quantile_axis(q, n):
+    # quantiles along a new first axis, broadcast against the counts
+    q = np.asarray(q, dtype=np.float64)
+    return q.reshape(q.shape + (1,) * np.ndim(n))
+
+def proposal_quantiles(n, q):
+    # quantiles of the number of block proposal opportunities in a year,
+    # with shape q.shape + n.shape
+    n = np.asarray(n)
+    return binom.ppf(_quantile_axis(q, n), SLOTS_PER_YEAR, 1 / n)
+
+def reward_bands(n, q=(0.01, 0.99)):
+    # ideal reward at quantiles of proposer luck: the attestation rewards
+    # are fixed, and the eighth of the inclusion rewards paid to proposers
+    # scales with the number of proposal opportunities
+    n = np.asarray(n)
+    full_reward = ideal_reward(n)
+    mean_proposals = SLOTS_PER_YEAR / n
+    luck = proposal_quantiles(n, q) / mean_proposals
+    return 0.75 * full_reward + \
+        0.25 * full_reward * ((7 / 8) + (1 / 8) * luck)
+
+def _draw(rng, mean, concentration, size):
+    # beta distributed values with the given mean, or the mean itself if
+    # there is no spread
+    if concentration is None or mean <= 0 or mean >= 1:
+        return np.full(size, float(mean))
+    return rng.beta(mean * concentration, (1 - mean) * concentration, size)
+
+def _simulate_chunk(args):
+    (n, size, participation, participation_concentration, uptime,
+     uptime_concentration, seed) = args
+    rng = np.random.default_rng(seed)
+    p = _draw(rng, participation, participation_concentration, size)
+    u = _draw(rng, uptime, uptime_concentration, size)
+    # proposal opportunities, of which only those while online are taken
+    proposals = rng.binomial(SLOTS_PER_YEAR, 1 / n, size)
+    proposed = rng.binomial(proposals, u)
+
+    b = annualised_base_reward(n)
+    attestation = 3 * p * u - 3 * (1 - u) + (7 / 8) * u * inclusion_factor(p)
+    block = (1 / 8) * p * proposed * n / SLOTS_PER_YEAR
+    return b * (attestation + block)
+
+def simulate(
+    n,
+    validator_years=1000000,
+    participation=1,
+    uptime=1,
+    participation_concentration=None,
+    uptime_concentration=None,
+    chunk_size=1000000,
+    processes=1,
+    seed=0
+):
+    # annual net rewards of independent validator-years on a network of n
+    # validators. each draws its proposer luck, its uptime and the network
+    # participation rate (beta distributed around the given means when a
+    # concentration is given, a + b of the beta distribution). the draws are
+    # made in chunks, each with its own spawned seed, so the result only
+    # depends on the seed and chunk size, not on the number of processes
+    seeds = np.random.SeedSequence(seed).spawn(
+        -(-validator_years // chunk_size)
+    )
+    chunks = [
+        (n, min(chunk_size, validator_years - i * chunk_size), participation,
+         participation_concentration, uptime, uptime_concentration, s)
+        for i, s in enumerate(seeds)
+    ]
+    if processes > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_simulate_chunk, chunks)
+    else:
+        results = [_simulate_chunk(chunk) for chunk in chunks]
+    return np.concatenate(results) if results else np.empty(0)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="monte carlo sweep of annual validator net rewards"
+    )
+    parser.add_argument(
+        '-n', '--validators', type=int, nargs='+', default=[100000]
+    )
+    parser.add_argument(
+        '-P', '--participation', type=float, nargs='+', default=[0.99]
+    )
+    parser.add_argument('-U', '--uptime', type=float, nargs='+', default=[0.99])
+    parser.add_argument(
+        '--participation-concentration', type=float,
+        help="spread the participation rate of each validator-year with a "
+             "beta distribution of this concentration (default: fixed)"
+    )
+    parser.add_argument(
+        '--uptime-concentration', type=float,
+        help="spread the uptime of each validator-year with a beta "
+             "distribution of this concentration (default: fixed)"
+    )
+    parser.add_argument('-y', '--validator-years', type=int, default=1000000)
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000000)
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    q = [1, 25, 50, 75, 99]
+    print(f"{'n':>8} {'P':>5} {'U':>5} {'model':>7} {'mean':>7} "
+          + ' '.join(f"{'p' + str(x):>7}" for x in q) + '  (ETH)')
+    for n in args.validators:
+        for participation in args.participation:
+            for uptime in args.uptime:
+                start_time = time.perf_counter()
+                rewards = simulate(
+                    n,
+                    args.validator_years,
+                    participation,
+                    uptime,
+                    args.participation_concentration,
+                    args.uptime_concentration,
+                    args.chunk_size,
+                    args.processes,
+                    args.seed
+                )
+                seconds = time.perf_counter() - start_time
+                model = expected_reward(n, participation, uptime)
+                print(f"{n:>8} {participation:>5.3f} {uptime:>5.3f} "
+                      f"{model:>7.4f} {rewards.mean():>7.4f} "
+                      + ' '.join(f"{v:>7.4f}"
+                                 for v in np.percentile(rewards, q))
+                      + f"  {seconds:.2f}s")
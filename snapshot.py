@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+from psycopg2 import sql
+
+import data_sources
+from data_sources import EPOCH_TABLES, FETCH_SIZE, SCHEMA, PostgresSource
+
+# export chaind tables to .npy column files in the layout read by
+# data_sources.FileSource, so that reruns of the reward scripts and the
+# notebooks read memory-mapped files instead of the database:
+#
+#   <directory>/<table>/<first epoch>/<column>.npy  per-epoch tables
+#   <directory>/<table>/all/<column>.npy            other tables
+#
+# partitions start every partition_epochs epochs from the first exported
+# epoch, and their rows are sorted by f_epoch or f_slot (then by validator,
+# committee index or member) as FileSource expects. committees are exploded
+# to one row per member, bytea columns are stored as 2D uint8 arrays,
+# null integers as -1 and null booleans as false
+
+SLOT_TABLES = {'t_beacon_committees', 't_proposer_duties', 't_blocks'}
+
+ORDER = {
+    't_validator_balances': 'f_epoch, f_validator_index',
+    't_proposer_duties': 'f_slot',
+    't_blocks': 'f_slot',
+    't_epoch_summaries': 'f_epoch',
+    't_validator_epoch_summaries': 'f_epoch, f_validator_index',
+    't_validators': 'f_index',
+    't_deposits': 'f_inclusion_slot',
+    't_proposer_slashings': 'f_inclusion_slot, f_inclusion_index',
+    't_attester_slashings': 'f_inclusion_slot, f_inclusion_index'
+}
+
+COMMITTEES_QUERY = (
+    "SELECT c.f_slot, c.f_index, m.f_validator_index "
+    "FROM t_beacon_committees c, "
+    "    unnest(c.f_committee) WITH ORDINALITY m(f_validator_index, i) "
+    "WHERE c.f_slot BETWEEN %s AND %s "
+    "ORDER BY c.f_slot, c.f_index, m.i"
+)
+
+META_FILE = 'snapshot.json'
+
+def table_columns(table):
+    # (column, type) pairs of a table, with committees exploded
+    if table == 't_beacon_committees':
+        return [
+            ('f_slot', 'bigint'),
+            ('f_index', 'bigint'),
+            ('f_validator_index', 'bigint')
+        ]
+    return [
+        tuple(column.split()[:2]) for column in SCHEMA[table].split(', ')
+    ]
+
+def _select(table, columns, where):
+    # select the table's columns with nulls replaced, bytea columns last
+    fields = []
+    for name, kind in sorted(columns, key=lambda c: c[1] == 'bytea'):
+        field = sql.Identifier(name)
+        if kind == 'boolean':
+            field = sql.SQL("COALESCE({}::int, 0)").format(field)
+        elif kind != 'bytea':
+            field = sql.SQL("COALESCE({}, -1)").format(field)
+        fields.append(field)
+    return sql.SQL("SELECT {} FROM {} {} ORDER BY {}").format(
+        sql.SQL(', ').join(fields),
+        sql.Identifier(table),
+        sql.SQL(where),
+        sql.SQL(ORDER[table])
+    )
+
+class PartitionExport:
+    # streams query results into one raw file per column, converted to .npy
+    # files once the partition is complete. the partition is written to a
+    # temporary directory and renamed into place, so it is either complete
+    # or absent
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        # numeric columns first, as selected
+        self.columns = sorted(columns, key=lambda c: c[1] == 'bytea')
+        self.files = {
+            name: open(os.path.join(self.tmp_path, name + '.bin'), 'wb')
+            for name, _ in self.columns
+        }
+        self.widths = {}
+        self.n_rows = 0
+
+    def write(self, rows):
+        n_numeric = sum(1 for _, kind in self.columns if kind != 'bytea')
+        numeric = np.array(
+            [r[:n_numeric] for r in rows], dtype=np.int64
+        ).reshape(len(rows), n_numeric)
+        for i, (name, kind) in enumerate(self.columns):
+            if kind == 'bytea':
+                values = [bytes(r[i]) for r in rows]
+                self.widths[name] = len(values[0])
+                self.files[name].write(b''.join(values))
+            elif kind == 'boolean':
+                self.files[name].write(numeric[:, i].astype(bool).tobytes())
+            else:
+                self.files[name].write(numeric[:, i].tobytes())
+        self.n_rows += len(rows)
+
+    def finish(self):
+        for name, kind in self.columns:
+            self.files[name].close()
+            raw = os.path.join(self.tmp_path, name + '.bin')
+            if kind == 'bytea':
+                dtype, shape = np.uint8, (self.n_rows, self.widths.get(name, 0))
+            elif kind == 'boolean':
+                dtype, shape = bool, (self.n_rows,)
+            else:
+                dtype, shape = np.int64, (self.n_rows,)
+            out = np.lib.format.open_memmap(
+                os.path.join(self.tmp_path, name + '.npy'),
+                mode='w+',
+                dtype=dtype,
+                shape=shape
+            )
+            if self.n_rows and shape[-1]:
+                out[:] = np.memmap(raw, dtype=dtype, mode='r', shape=shape)
+            out.flush()
+            del out
+            os.remove(raw)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+def export_partition(source, table, path, query, params=None):
+    # run a query through a server-side cursor into a partition directory
+    export = PartitionExport(path, table_columns(table))
+    with source.connection(autocommit=False) as connection:
+        with connection.cursor('snapshot') as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                export.write(rows)
+    export.finish()
+    return export.n_rows
+
+def partition_query(table, first, last):
+    # query and parameters for the rows of epochs [first, last]
+    if table == 't_beacon_committees':
+        return COMMITTEES_QUERY, (first * 32, last * 32 + 31)
+    key = 'f_slot' if table in SLOT_TABLES else 'f_epoch'
+    where = "WHERE %s BETWEEN %%s AND %%s" % key
+    query = _select(table, table_columns(table), where)
+    if key == 'f_slot':
+        return query, (first * 32, last * 32 + 31)
+    return query, (first, last)
+
+def snapshot(
+    source,
+    directory,
+    start=0,
+    end=None,
+    partition_epochs=256,
+    reset=False,
+    progress=True
+):
+    # export epochs [start, end] (default: up to the latest epoch summary)
+    # of the per-epoch tables, and all rows of the other tables. a snapshot
+    # extended with the same start and partition size only re-exports the
+    # partitions after the last complete one
+    if end is None:
+        end = source.latest_summary_epoch()
+    meta_path = os.path.join(directory, META_FILE)
+    previous_end = -1
+    if os.path.exists(meta_path) and not reset:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['start_epoch'] == start and \
+                meta['partition_epochs'] == partition_epochs:
+            previous_end = meta['end_epoch']
+    os.makedirs(directory, exist_ok=True)
+
+    for first in range(start, end + 1, partition_epochs):
+        last = first + partition_epochs - 1
+        if last <= min(previous_end, end):
+            continue
+        last = min(last, end)
+        for table in EPOCH_TABLES:
+            query, params = partition_query(table, first, last)
+            path = os.path.join(directory, table, str(first))
+            n = export_partition(source, table, path, query, params)
+            if progress:
+                print(f"exported {n} rows of {table} for epochs "
+                      f"{first}-{last}", end='\r')
+
+    for table in SCHEMA:
+        if table in EPOCH_TABLES:
+            continue
+        query = _select(table, table_columns(table), '')
+        export_partition(
+            source, table, os.path.join(directory, table, 'all'), query
+        )
+
+    with open(meta_path, 'w') as f:
+        json.dump({
+            'start_epoch': start,
+            'end_epoch': end,
+            'partition_epochs': partition_epochs
+        }, f, indent=2)
+    if progress:
+        print()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="export chaind tables to memory-mapped .npy files, for "
+                    "use with --data DIR"
+    )
+    parser.add_argument('directory')
+    parser.add_argument('-s', '--start', type=int, default=0)
+    parser.add_argument(
+        '-e', '--end', type=int,
+        help="last epoch to export (default: latest epoch summary)"
+    )
+    parser.add_argument('-p', '--partition-epochs', type=int, default=256)
+    parser.add_argument(
+        '-r', '--reset', action='store_true',
+        help="re-export all partitions instead of extending the snapshot"
+    )
+    data_sources.add_arguments(parser)
+    args = parser.parse_args()
+
+    source = data_sources.from_args(args)
+    if not isinstance(source, PostgresSource):
+        parser.error("snapshots are exported from the chaind database")
+    snapshot(
+        source,
+        args.directory,
+        start=args.start,
+        end=args.end,
+        partition_epochs=args.partition_epochs,
+        reset=args.reset
+    )
+    source.close()
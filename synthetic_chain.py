@@ -0,0 +1,505 @@
+import argparse
+import io
+import json
+import math
+import os
+
+import numpy as np
+import psycopg2
+
+from data_sources import EPOCH_TABLES, SCHEMA
+
+EB_INCREMENT = int(1e9)
+MAX_EFFECTIVE_BALANCE = 32 # in units of EB_INCREMENT
+SLOTS_PER_EPOCH = 32
+TARGET_COMMITTEE_SIZE = 128
+
+# indexes on the chaind tables, created once they are loaded
+
+INDEXES = [
+    "CREATE UNIQUE INDEX ON t_validators (f_index)",
+    "CREATE UNIQUE INDEX ON t_validator_balances (f_validator_index, f_epoch)",
+    "CREATE INDEX ON t_validator_balances (f_epoch)",
+    "CREATE UNIQUE INDEX ON t_beacon_committees (f_slot, f_index)",
+    "CREATE UNIQUE INDEX ON t_proposer_duties (f_slot)",
+    "CREATE INDEX ON t_blocks (f_slot)",
+    "CREATE UNIQUE INDEX ON t_epoch_summaries (f_epoch)",
+    "CREATE UNIQUE INDEX ON t_validator_epoch_summaries "
+    "    (f_validator_index, f_epoch)",
+    "CREATE INDEX ON t_validator_epoch_summaries (f_epoch)"
+]
+
+class SyntheticChain:
+    # a randomly generated chain with the statistical shape of mainnet:
+    # validators activating over time, imperfect participation, missed
+    # slots, validators with impaired balances, slashings and top-up
+    # deposits. tables are produced one epoch at a time as dicts of column
+    # arrays, so datasets larger than memory can be streamed to a backend.
+    # committees are exploded to one row per member (f_validator_index)
+
+    def __init__(
+        self,
+        n_validators=20000,
+        n_epochs=100,
+        participation=0.97,
+        missed_slots=0.02,
+        impaired=0.01,
+        slashings=4,
+        redeposits=4,
+        genesis_fraction=0.9,
+        seed=0
+    ):
+        self.n_validators = n_validators
+        self.n_epochs = n_epochs
+        self.participation = participation
+        self.missed_slots = missed_slots
+        self.impaired = impaired
+        self.n_slashings = slashings
+        self.n_redeposits = redeposits
+        self.genesis_fraction = genesis_fraction
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self._generate_validators()
+
+    def parameters(self):
+        return {
+            'n_validators': self.n_validators,
+            'n_epochs': self.n_epochs,
+            'participation': self.participation,
+            'missed_slots': self.missed_slots,
+            'impaired': self.impaired,
+            'slashings': self.n_slashings,
+            'redeposits': self.n_redeposits,
+            'genesis_fraction': self.genesis_fraction,
+            'seed': self.seed
+        }
+
+    def _generate_validators(self):
+        rng = self.rng
+        n, n_epochs = self.n_validators, self.n_epochs
+
+        # genesis validators plus a queue activating over the epoch range
+        n_genesis = max(int(n * self.genesis_fraction), 1)
+        self.activation_epoch = np.zeros(n, dtype=np.int64)
+        self.activation_epoch[n_genesis:] = np.sort(
+            rng.integers(1, max(n_epochs, 2), n - n_genesis)
+        )
+        self.exit_epoch = np.full(n, -1, dtype=np.int64) # -1 for none
+        self.slashed = np.zeros(n, dtype=bool)
+        self.pubkeys = rng.integers(0, 256, (n, 48), dtype=np.uint8)
+
+        # per-validator uptime around the target participation rate, with a
+        # small share of badly performing validators
+        self.uptime = np.clip(
+            rng.normal(self.participation, 0.02, n), 0, 1
+        )
+        offline = rng.random(n) < (1 - self.participation) / 4
+        self.uptime[offline] = rng.random(offline.sum()) * 0.5
+
+        # validators whose balance is impaired (effective balance < 32 ETH)
+        # at a random epoch
+        n_impaired = int(n * self.impaired)
+        impaired = rng.choice(n_genesis, min(n_impaired, n_genesis), False)
+        self.impairments = {}
+        for i in impaired:
+            epoch = int(rng.integers(0, max(n_epochs, 1)))
+            amount = int(rng.integers(1, 4)) * EB_INCREMENT
+            self.impairments.setdefault(epoch, []).append((i, amount))
+
+        # slashed validators exit a few epochs after they are slashed
+        candidates = rng.permutation(n_genesis)
+        self.slashing_epochs = {}
+        for i in candidates[:self.n_slashings]:
+            epoch = int(rng.integers(0, max(n_epochs - 1, 1)))
+            self.slashing_epochs.setdefault(epoch, []).append(int(i))
+            self.slashed[i] = True
+            self.exit_epoch[i] = epoch + 4
+
+        # top-up deposits to already active validators
+        self.redeposits = {}
+        for i in candidates[self.n_slashings:][:self.n_redeposits]:
+            slot = int(rng.integers(SLOTS_PER_EPOCH + 1, max(n_epochs, 2) * 32))
+            epoch = (slot - 1) // SLOTS_PER_EPOCH + 1
+            self.redeposits.setdefault(epoch, []).append((int(i), slot))
+
+        self.balance = np.full(n, MAX_EFFECTIVE_BALANCE * EB_INCREMENT)
+        self.effective_balance = np.full(n, MAX_EFFECTIVE_BALANCE)
+        self.filled_next = self._filled_slots()
+        self.deposits = []
+        self.proposer_slashings = []
+        self.attester_slashings = []
+
+        # initial deposits for validators activating after genesis
+        for i in range(n_genesis, n):
+            slot = max(int(self.activation_epoch[i] - 1) * SLOTS_PER_EPOCH, 1)
+            self.deposits.append(
+                (slot, i, MAX_EFFECTIVE_BALANCE * EB_INCREMENT)
+            )
+
+    def _filled_slots(self):
+        filled = self.rng.random(SLOTS_PER_EPOCH) >= self.missed_slots
+        filled[0] |= not filled.any()
+        return filled
+
+    def _update_effective_balance(self):
+        # spec hysteresis: only move when the balance leaves the band
+        eb = self.effective_balance * EB_INCREMENT
+        down = self.balance + EB_INCREMENT // 4 < eb
+        up = eb + 5 * EB_INCREMENT // 4 < self.balance
+        change = down | up
+        self.effective_balance[change] = np.minimum(
+            self.balance[change] // EB_INCREMENT, MAX_EFFECTIVE_BALANCE
+        )
+
+    def epochs(self):
+        # yield (epoch, {table: {column: array}}) for every epoch in turn
+        for epoch in range(self.n_epochs):
+            yield epoch, self._epoch(epoch)
+
+    def _epoch(self, epoch):
+        rng = self.rng
+        n = self.n_validators
+        e0 = epoch * SLOTS_PER_EPOCH
+        slots = np.arange(e0, e0 + SLOTS_PER_EPOCH)
+
+        active = (self.activation_epoch <= epoch) \
+               & ((self.exit_epoch < 0) | (epoch < self.exit_epoch))
+        active_index = np.flatnonzero(active)
+        eb = self.effective_balance.copy()
+        balances = {
+            'f_validator_index': np.arange(n, dtype=np.int64),
+            'f_epoch': np.full(n, epoch, dtype=np.int64),
+            'f_balance': self.balance.copy(),
+            'f_effective_balance': eb * EB_INCREMENT
+        }
+
+        # proposers and blocks (filled slots are known one epoch ahead so
+        # that inclusion delays can be drawn)
+        filled = self.filled_next
+        self.filled_next = self._filled_slots()
+        filled_both = np.concatenate([filled, self.filled_next])
+        proposers = rng.choice(active_index, SLOTS_PER_EPOCH)
+        n_blocks = int(filled.sum())
+
+        # committees: shuffle the active set and split it across the slots
+        # and then into committees of up to TARGET_COMMITTEE_SIZE
+        shuffled = rng.permutation(active_index)
+        per_slot = np.array_split(shuffled, SLOTS_PER_EPOCH)
+        committee_slot, committee_index, members = [], [], []
+        attestation_slot = np.full(n, -1, dtype=np.int64)
+        for s, validators in enumerate(per_slot):
+            n_committees = max(
+                math.ceil(len(validators) / TARGET_COMMITTEE_SIZE), 1
+            )
+            for c, committee in enumerate(
+                np.array_split(validators, n_committees)
+            ):
+                committee_slot.append(np.full(len(committee), e0 + s))
+                committee_index.append(np.full(len(committee), c))
+                members.append(committee)
+            attestation_slot[validators] = s
+
+        # attestation performance
+        included = active & (rng.random(n) < self.uptime)
+        target = included & (rng.random(n) < 0.98)
+        head = included & (rng.random(n) < 0.95)
+        next_filled = np.flatnonzero(filled_both)
+        s = np.clip(attestation_slot, 0, None)
+        min_delay = next_filled[np.searchsorted(next_filled, s + 1)] - s \
+            if len(next_filled) and next_filled[-1] > s.max() \
+            else np.ones(n, dtype=np.int64)
+        delay = min_delay + rng.geometric(0.85, n) - 1
+        duties = np.bincount(proposers, minlength=n)
+        proposals = np.bincount(proposers[filled], minlength=n)
+
+        index = active_index
+        validator_summaries = {
+            'f_validator_index': index,
+            'f_epoch': np.full(len(index), epoch, dtype=np.int64),
+            'f_proposer_duties': duties[index],
+            'f_proposals_included': proposals[index],
+            'f_attestation_included': included[index],
+            'f_attestation_target_correct': target[index],
+            'f_attestation_head_correct': head[index],
+            'f_attestation_inclusion_delay': np.where(
+                included[index], delay[index], -1
+            )
+        }
+
+        gwei = eb * EB_INCREMENT
+        epoch_summary = {
+            'f_epoch': np.array([epoch]),
+            'f_activation_queue_length': np.array(
+                [int((self.activation_epoch > epoch).sum())]
+            ),
+            'f_activating_validators': np.array(
+                [int((self.activation_epoch == epoch + 1).sum())]
+            ),
+            'f_active_validators': np.array([len(index)]),
+            'f_active_real_balance': np.array(
+                [int(self.balance[active].sum())]
+            ),
+            'f_active_balance': np.array([int(gwei[active].sum())]),
+            'f_attesting_validators': np.array([int(included.sum())]),
+            'f_attesting_balance': np.array([int(gwei[included].sum())]),
+            'f_target_correct_validators': np.array([int(target.sum())]),
+            'f_target_correct_balance': np.array([int(gwei[target].sum())]),
+            'f_head_correct_validators': np.array([int(head.sum())]),
+            'f_head_correct_balance': np.array([int(gwei[head].sum())])
+        }
+
+        # slashings are included in a block of the epoch, by its proposer
+        for i in self.slashing_epochs.get(epoch, []):
+            slot = int(rng.choice(slots[filled]))
+            table = self.proposer_slashings if rng.random() < 0.5 \
+                else self.attester_slashings
+            table.append((slot, len(table)))
+            self.balance[i] -= EB_INCREMENT
+
+        # apply approximate rewards and penalties to the balances of the
+        # next epoch
+        total = max(int(gwei[active].sum()), EB_INCREMENT)
+        br = gwei * 16 // math.isqrt(total)
+        p = int(gwei[included].sum()) / total
+        delay_reward = (7 * br // 8) // np.maximum(delay, 1)
+        reward = np.where(
+            included, (3 * br * p).astype(np.int64) + delay_reward, -3 * br
+        )
+        self.balance[active] += reward[active]
+        block_reward = int(br.mean() * p * len(index) / (8 * SLOTS_PER_EPOCH))
+        np.add.at(self.balance, proposers[filled], block_reward)
+
+        for i, amount in self.impairments.get(epoch, []):
+            self.balance[i] -= amount
+        for i, slot in self.redeposits.get(epoch + 1, []):
+            if self.activation_epoch[i] < slot // SLOTS_PER_EPOCH:
+                self.balance[i] += EB_INCREMENT
+                self.deposits.append((slot, i, EB_INCREMENT))
+        self._update_effective_balance()
+
+        return {
+            't_validator_balances': balances,
+            't_beacon_committees': {
+                'f_slot': np.concatenate(committee_slot),
+                'f_index': np.concatenate(committee_index),
+                'f_validator_index': np.concatenate(members)
+            },
+            't_proposer_duties': {
+                'f_slot': slots,
+                'f_validator_index': proposers
+            },
+            't_blocks': {
+                'f_slot': slots[filled],
+                'f_proposer_index': proposers[filled],
+                'f_root': rng.integers(0, 256, (n_blocks, 32), dtype=np.uint8),
+                'f_canonical': np.ones(n_blocks, dtype=bool)
+            },
+            't_epoch_summaries': epoch_summary,
+            't_validator_epoch_summaries': validator_summaries
+        }
+
+    def static_tables(self):
+        # tables holding the final state, available once all epochs have
+        # been generated
+        deposits = sorted(self.deposits)
+        return {
+            't_validators': {
+                'f_public_key': self.pubkeys,
+                'f_index': np.arange(self.n_validators, dtype=np.int64),
+                'f_slashed': self.slashed,
+                'f_activation_eligibility_epoch': np.maximum(
+                    self.activation_epoch - 1, 0
+                ),
+                'f_activation_epoch': self.activation_epoch,
+                'f_exit_epoch': self.exit_epoch,
+                'f_withdrawable_epoch': np.where(
+                    self.exit_epoch < 0, -1, self.exit_epoch + 256
+                ),
+                'f_effective_balance': self.effective_balance * EB_INCREMENT
+            },
+            't_deposits': {
+                'f_inclusion_slot': np.array(
+                    [d[0] for d in deposits], dtype=np.int64
+                ),
+                'f_validator_pubkey': self.pubkeys[
+                    np.array([d[1] for d in deposits], dtype=np.int64)
+                ],
+                'f_amount': np.array([d[2] for d in deposits], dtype=np.int64)
+            },
+            't_proposer_slashings': _slashings_columns(self.proposer_slashings),
+            't_attester_slashings': _slashings_columns(self.attester_slashings)
+        }
+
+def _slashings_columns(rows):
+    return {
+        'f_inclusion_slot': np.array([r[0] for r in rows], dtype=np.int64),
+        'f_inclusion_index': np.array([r[1] for r in rows], dtype=np.int64)
+    }
+
+# nullable bigint columns, where -1 stands for null in the arrays
+
+NULLABLE = {
+    'f_exit_epoch',
+    'f_withdrawable_epoch',
+    'f_attestation_inclusion_delay'
+}
+
+def _copy_text(columns):
+    # COPY text for a dict of column arrays (bytea columns are 2D uint8)
+    n = len(next(iter(columns.values())))
+    fields = []
+    for name, values in columns.items():
+        if values.ndim == 2:
+            text = ['\\\\x' + bytes(r).hex() for r in values]
+        elif values.dtype == bool:
+            text = np.where(values, 't', 'f')
+        else:
+            text = values.astype(str)
+            if name in NULLABLE:
+                text = np.where(values < 0, '\\N', text)
+        fields.append(np.asarray(text, dtype=object))
+    lines = ['\t'.join(r) for r in zip(*fields)] if n else []
+    return io.StringIO('\n'.join(lines) + '\n' if lines else '')
+
+def _committee_rows(columns):
+    # regroup exploded committee members into one bigint[] per committee
+    slot, index = columns['f_slot'], columns['f_index']
+    members = columns['f_validator_index']
+    if not len(slot):
+        return {'f_slot': slot, 'f_index': index, 'f_committee': []}
+    change = np.flatnonzero((np.diff(slot) != 0) | (np.diff(index) != 0)) + 1
+    starts = np.concatenate([[0], change])
+    return {
+        'f_slot': slot[starts],
+        'f_index': index[starts],
+        'f_committee': np.array([
+            '{' + ','.join(map(str, m.tolist())) + '}'
+            for m in np.split(members, change)
+        ], dtype=object)
+    }
+
+def _copy(cursor, table, columns):
+    if table == 't_beacon_committees':
+        columns = _committee_rows(columns)
+        text = io.StringIO(''.join(
+            f"{s}\t{i}\t{c}\n" for s, i, c in zip(
+                columns['f_slot'].tolist(),
+                columns['f_index'].tolist(),
+                columns['f_committee']
+            )
+        ))
+    else:
+        text = _copy_text(columns)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN", text
+    )
+
+def load_postgres(chain, connection, progress=True):
+    # (re)create the chaind tables and stream the chain into them
+    with connection.cursor() as cursor:
+        for table, columns in SCHEMA.items():
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            cursor.execute(f"CREATE TABLE {table} ({columns})")
+        connection.commit()
+
+        for epoch, tables in chain.epochs():
+            for table, columns in tables.items():
+                _copy(cursor, table, columns)
+            connection.commit()
+            if progress:
+                print(f"loaded epoch {epoch}", end='\r')
+
+        for table, columns in chain.static_tables().items():
+            _copy(cursor, table, columns)
+        for query in INDEXES:
+            cursor.execute(query)
+        connection.commit()
+    if progress:
+        print()
+
+def _save_partition(directory, table, partition, chunks):
+    path = os.path.join(directory, table, partition)
+    os.makedirs(path, exist_ok=True)
+    for column in chunks[0]:
+        np.save(
+            os.path.join(path, column + '.npy'),
+            np.concatenate([c[column] for c in chunks])
+        )
+
+def save(chain, directory, partition_epochs=256, progress=True):
+    # write the chain as one .npy file per column, in the layout
+    #   <directory>/<table>/<first epoch of partition>/<column>.npy
+    # for per-epoch tables and <directory>/<table>/all/<column>.npy for the
+    # rest. bytea columns are stored as 2D uint8 arrays and committees as
+    # one row per member
+    os.makedirs(directory, exist_ok=True)
+    chunks = {table: [] for table in EPOCH_TABLES}
+    first = 0
+    for epoch, tables in chain.epochs():
+        for table, columns in tables.items():
+            chunks[table].append(columns)
+        if (epoch + 1) % partition_epochs == 0 or epoch + 1 == chain.n_epochs:
+            for table in EPOCH_TABLES:
+                _save_partition(directory, table, str(first), chunks[table])
+                chunks[table] = []
+            first = epoch + 1
+        if progress:
+            print(f"generated epoch {epoch}", end='\r')
+
+    for table, columns in chain.static_tables().items():
+        _save_partition(directory, table, 'all', [columns])
+
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({
+            'n_epochs': chain.n_epochs,
+            'partition_epochs': partition_epochs,
+            'synthetic': chain.parameters()
+        }, f, indent=2)
+    if progress:
+        print()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="generate a synthetic chaind dataset"
+    )
+    parser.add_argument('-n', '--validators', type=int, default=20000)
+    parser.add_argument('-e', '--epochs', type=int, default=100)
+    parser.add_argument('--participation', type=float, default=0.97)
+    parser.add_argument('--missed-slots', type=float, default=0.02)
+    parser.add_argument('--impaired', type=float, default=0.01)
+    parser.add_argument('--slashings', type=int, default=4)
+    parser.add_argument('--redeposits', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '-o', '--output',
+        help="write .npy column files to this directory instead of postgres"
+    )
+    parser.add_argument('--user', default='chain')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--database', default='chain')
+    parser.add_argument('--password', default='medalla')
+    args = parser.parse_args()
+
+    chain = SyntheticChain(
+        n_validators=args.validators,
+        n_epochs=args.epochs,
+        participation=args.participation,
+        missed_slots=args.missed_slots,
+        impaired=args.impaired,
+        slashings=args.slashings,
+        redeposits=args.redeposits,
+        seed=args.seed
+    )
+
+    if args.output:
+        save(chain, args.output)
+    else:
+        connection = psycopg2.connect(
+            user=args.user,
+            host=args.host,
+            database=args.database,
+            password=args.password
+        )
+        load_postgres(chain, connection)
+        connection.close()
@@ -1,21 +1,77 @@
-import sys
+import argparse
 import math
+import multiprocessing
+import queue
+import sys
+import threading
+from collections import Counter
 
+import numpy as np
+
+from attestation_rewards import reward_tables, epoch_attestation_rewards
+import data_sources
+import fingerprints
 from chaind_extras import ChainDB
+from instrumentation import Metrics, add_arguments, from_args
+from validator_store import ValidatorStore
 
 EB_INCREMENT = int(1e9)
 
-if __name__ == '__main__':
+def attestation_rewards(chaind, e, min_delays, base_reward,
+                        i_reward, t_reward, h_reward):
+    # reference implementation: update each scheduled attestor in turn
+    max_d_reward = [0] * 32
+    max_reward = max_d_reward.copy()
 
-    reset = True if '--reset' in sys.argv or '-r' in sys.argv else False
-    chaind = ChainDB(reset=reset)
+    e0 = e * 32
+    for s in range(e0, e0 + 32): # iterate through slots in this epoch
 
-    latest_epoch = chaind.get_latest_extras_epoch()
-    if latest_epoch is None:
-        e = 0
-    else:
-        e = latest_epoch + 1
+        min_inclusion_delay = int(min_delays[s % 32])
+
+        # calculate the maximum attestation reward for this slot
+
+        for eb in range(1, 33):
+            br = base_reward[eb-1]
+            max_d_reward[eb-1] = (br - br // 8) // min_inclusion_delay
+            max_reward[eb-1] = i_reward[eb-1] + t_reward[eb-1] \
+                             + h_reward[eb-1] + max_d_reward[eb-1]
+
+        # calculate attestation rewards earned/missed by each validator
+
+        val_indices = chaind.get_scheduled_attestors(s)
+        for val_index in val_indices:
+            v = chaind.validators[val_index]
+            eb = v['effective_balance']
+            v['max_attestation_reward'] += max_reward[eb-1]
+            v['attestation_slot'] = s
+            br = base_reward[eb-1]
 
+            att_reward = 0
+            if v['attestation_included']:
+                att_reward += i_reward[eb-1]
+                dr = (br - br // 8) // v['inclusion_delay']
+                att_reward += dr
+                v['shortfall_delay'] += max_d_reward[eb-1] - dr
+                if v['target_correct']:
+                    att_reward += t_reward[eb-1]
+                else:
+                    att_reward -= br
+                    v['shortfall_target'] += t_reward[eb-1] + br
+                if v['head_correct']:
+                    att_reward += h_reward[eb-1]
+                else:
+                    att_reward -= br
+                    v['shortfall_head'] += h_reward[eb-1] + br
+            else:
+                att_reward -= 3* br
+                v['shortfall_missed'] += max_reward[eb-1] + 3 * br
+
+            v['this_att_reward'] = att_reward
+            v['attestation_reward'] += att_reward
+
+def reference_epochs(chaind, e, end):
+    # process epochs [e, end) with the per-attestor reference loop, yielding
+    # each epoch once the validator state has been updated
     summary_e1 = chaind.get_epoch_summary_balances(e)
     filled_slots = [0] * 64
     filled_slots[32:] = chaind.get_filled_slots(e)
@@ -24,11 +80,8 @@ if __name__ == '__main__':
     i_reward = base_reward.copy()
     t_reward = base_reward.copy()
     h_reward = base_reward.copy()
-    max_d_reward = base_reward.copy()
-    max_reward = base_reward.copy()
 
-    latest_epoch = chaind.get_latest_summary_epoch()
-    while e < latest_epoch - 1: # iterate through available epochs
+    while e < end:
         summary_e = summary_e1
         summary_e1 = chaind.get_epoch_summary_balances(e+1)
         filled_slots[:32] = filled_slots[32:]
@@ -45,75 +98,357 @@ if __name__ == '__main__':
             h_reward[eb-1] = (br * summary_e['head'])      // ab
 
         chaind.load_validator_epoch_summary(e)
+        with chaind.metrics.stage('rewards'):
+            attestation_rewards(chaind, e,
+                                chaind.get_min_inclusion_delays(e),
+                                base_reward, i_reward, t_reward, h_reward)
 
-        e0 = e * 32
-        for s in range(e0, e0 + 32): # iterate through slots in this epoch
+        # calculate block rewards earned/missed by each proposer
 
-            min_inclusion_delay = 1
-            while not filled_slots[s % 32 + min_inclusion_delay]:
-                min_inclusion_delay += 1
+        with chaind.metrics.stage('proposers'):
+            proposers = chaind.get_shifted_proposers(e)
+            props_included = Counter(
+                val_index for i, val_index in enumerate(proposers)
+                if filled_slots[i+1]
+            )
+            bal_changes = chaind.get_balance_deltas(e, list(props_included))
+            for i, val_index in enumerate(proposers):
+                v = chaind.validators[val_index]
+                if filled_slots[i+1]:
+                    bal_change = bal_changes[val_index]
+                    att_reward = v['this_att_reward']
+                    block_reward = (bal_change - att_reward) \
+                                 // props_included[val_index]
+                    v['block_reward'] += block_reward
+                else:
+                    numerator = base_reward[0] * summary_e['attesting']
+                    est_br = numerator // (EB_INCREMENT * 8 * 32)
+                    v['missed_block_reward'] += est_br
 
-            # calculate the maximum attestation reward for this slot
+        yield e
+        e += 1
 
-            for eb in range(1, 33):
-                br = base_reward[eb-1]
-                max_d_reward[eb-1] = (br - br // 8) // min_inclusion_delay
-                max_reward[eb-1] = i_reward[eb-1] + t_reward[eb-1] \
-                                 + h_reward[eb-1] + max_d_reward[eb-1]
+def fetch_epoch(chaind, e):
+    # all chain data needed to calculate the increments for epoch e
+    filled_slots = chaind.get_filled_slots(e) + chaind.get_filled_slots(e+1)
+    proposers = chaind.get_shifted_proposers(e)
+    attestors, slots = chaind.get_epoch_attestors(e)
+    return {
+        'epoch'            : e,
+        'summary_e'        : chaind.get_epoch_summary_balances(e),
+        'summary_e1'       : chaind.get_epoch_summary_balances(e+1),
+        'filled_slots'     : filled_slots,
+        'min_delays'       : chaind.get_min_inclusion_delays(e),
+        'validator_summary': chaind.get_validator_epoch_summary(e),
+        'attestors'        : attestors,
+        'slots'            : slots,
+        'proposers'        : proposers,
+        'balance_deltas'   : chaind.get_balance_deltas(e, [
+            val_index
+            for i, val_index in enumerate(proposers) if filled_slots[i+1]
+        ])
+    }
 
-            # calculate attestation rewards earned/missed by each validator
+def epoch_increments(data, metrics=None):
+    # per-validator changes to the cumulative extras in one epoch. this only
+    # depends on the epoch's own chain data, so epochs can be calculated
+    # independently and summed in order afterwards
+    metrics = Metrics() if metrics is None else metrics
+    summary = data['validator_summary']
+    with metrics.stage('rewards'):
+        tables = reward_tables(data['summary_e'], data['summary_e1'])
+        increments = epoch_attestation_rewards(
+            tables,
+            data['min_delays'],
+            data['attestors'],
+            data['slots'],
+            summary['effective_balance'],
+            summary['attestation_included'],
+            summary['target_correct'],
+            summary['head_correct'],
+            summary['inclusion_delay']
+        )
+    increments['attestors'] = data['attestors']
+    increments['slots'] = data['slots']
+    with metrics.stage('proposers'):
+        proposer_increments(data, tables, increments)
+    return increments
 
-            val_indices = chaind.get_scheduled_attestors(s)
-            for val_index in val_indices:
-                v = chaind.validators[val_index]
-                eb = v['effective_balance']
-                v['max_attestation_reward'] += max_reward[eb-1]
-                v['attestation_slot'] = s
-                br = base_reward[eb-1]
-
-                att_reward = 0
-                if v['attestation_included']:
-                    att_reward += i_reward[eb-1]
-                    dr = (br - br // 8) // v['inclusion_delay']
-                    att_reward += dr
-                    v['shortfall_delay'] += max_d_reward[eb-1] - dr
-                    if v['target_correct']:
-                        att_reward += t_reward[eb-1]
-                    else:
-                        att_reward -= br
-                        v['shortfall_target'] += t_reward[eb-1] + br
-                    if v['head_correct']:
-                        att_reward += h_reward[eb-1]
-                    else:
-                        att_reward -= br
-                        v['shortfall_head'] += h_reward[eb-1] + br
-                else:
-                    att_reward -= 3* br
-                    v['shortfall_missed'] += max_reward[eb-1] + 3 * br
+def proposer_increments(data, tables, increments):
+    # add the block rewards earned/missed by each proposer to increments.
+    # block rewards are the proposer's balance change less its attestation
+    # reward, shared between the slots it proposed in this epoch
+    summary = data['validator_summary']
+    att_reward = np.zeros(len(summary['effective_balance']), dtype=np.int64)
+    att_reward[data['attestors']] = increments['attestation_reward']
 
-                v['this_att_reward'] = att_reward
-                v['attestation_reward'] += att_reward
+    filled_slots = data['filled_slots']
+    proposers = data['proposers']
+    props_included = Counter(
+        val_index for i, val_index in enumerate(proposers) if filled_slots[i+1]
+    )
+    numerator = int(tables['base'][0]) * data['summary_e']['attesting']
+    est_br = numerator // (EB_INCREMENT * 8 * 32)
 
-        # calculate block rewards earned/missed by each proposer
+    block_reward = [0] * len(proposers)
+    missed_block_reward = [0] * len(proposers)
+    for i, val_index in enumerate(proposers):
+        if filled_slots[i+1]:
+            bal_change = data['balance_deltas'][val_index]
+            block_reward[i] = (bal_change - int(att_reward[val_index])) \
+                            // props_included[val_index]
+        else:
+            missed_block_reward[i] = est_br
 
-        proposers = chaind.get_shifted_proposers(e)
-        for i, val_index in enumerate(proposers):
-            v = chaind.validators[val_index]
-            if filled_slots[i+1]:
-                bal_change = chaind.get_balance_delta(val_index, e)
-                props_included = 0
-                for j, vi in enumerate(proposers):
-                    if filled_slots[j+1] and vi == val_index:
-                        props_included += 1
-
-                att_reward = v['this_att_reward']
-                block_reward = (bal_change - att_reward) // props_included
-                v['block_reward'] += block_reward
-            else:
-                numerator = base_reward[0] * summary_e['attesting']
-                est_br = numerator // (EB_INCREMENT * 8 * 32)
-                v['missed_block_reward'] += est_br
+    increments['proposers'] = np.array(proposers, dtype=np.int64)
+    increments['block_reward'] = np.array(block_reward, dtype=np.int64)
+    increments['missed_block_reward'] = np.array(
+        missed_block_reward, dtype=np.int64
+    )
+
+ATTESTATION_INCREMENTS = (
+    'attestation_reward',
+    'max_attestation_reward',
+    'shortfall_missed',
+    'shortfall_target',
+    'shortfall_head',
+    'shortfall_delay'
+)
+
+def apply_increments(validators, e, increments):
+    # add one epoch's increments to the cumulative validator state
+    columns = validators.columns
+    attestors = increments['attestors']
+    slots = increments['slots'].astype(np.int64)
+    columns['attestation_slot'][attestors] = e * 32 + slots
+    columns['this_att_reward'][attestors] = increments['attestation_reward']
+    for field in ATTESTATION_INCREMENTS:
+        columns[field][attestors] += increments[field]
+
+    # a validator may propose more than one block in an epoch
+    proposers = increments['proposers']
+    np.add.at(columns['block_reward'], proposers, increments['block_reward'])
+    np.add.at(
+        columns['missed_block_reward'],
+        proposers,
+        increments['missed_block_reward']
+    )
 
-        chaind.insert_epoch_extras(e)
-        print(f"calculated validator epoch extras for epoch {e}", end='\r')
+def vectorized_epochs(chaind, e, end):
+    metrics = chaind.metrics
+    while e < end:
+        with metrics.stage('fetch'):
+            data = fetch_epoch(chaind, e)
+        increments = epoch_increments(data, metrics)
+        with metrics.stage('apply'):
+            apply_increments(chaind.validators, e, increments)
+        yield e
         e += 1
+
+def _fetch_epochs(fetcher, effective_balances, e, end, fetched, stop):
+    # fetch thread of pipelined_epochs: queue each epoch's chain data in turn,
+    # followed by None (or the exception which stopped the thread)
+    def put(item):
+        while not stop.is_set():
+            try:
+                fetched.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for e in range(e, end):
+            if e >= effective_balances.n_epochs:
+                effective_balances.extend(fetcher.source)
+            with fetcher.metrics.stage('fetch'):
+                item = fetch_epoch(fetcher, e)
+            if not put(item):
+                return
+        put(None)
+    except BaseException as error:
+        put(error)
+
+def pipelined_epochs(chaind, e, end, depth):
+    # numpy engine with the chain data for the next epochs fetched by a
+    # background thread, which shares the data source (and its connection
+    # pool) and the validator store, up to depth epochs ahead while the
+    # current epoch is calculated. the effective balance index is shared
+    # with (and only extended by) the fetch thread
+    fetcher = ChainDB(
+        chaind.source,
+        read_only=True,
+        prefetch_window=chaind.prefetch_window,
+        metrics=chaind.metrics,
+        validators=chaind.validators
+    )
+    fetcher.effective_balances = chaind.effective_balances
+    fetched = queue.Queue(depth)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_fetch_epochs,
+        args=(fetcher, chaind.effective_balances, e, end, fetched, stop),
+        daemon=True
+    )
+    thread.start()
+
+    metrics = chaind.metrics
+    try:
+        while True:
+            with metrics.stage('wait'):
+                data = fetched.get()
+            if data is None:
+                break
+            if isinstance(data, BaseException):
+                raise data
+            increments = epoch_increments(data, metrics)
+            with metrics.stage('apply'):
+                apply_increments(chaind.validators, data['epoch'], increments)
+            yield data['epoch']
+    finally:
+        stop.set()
+        thread.join()
+
+# each worker process opens its own data source, from the type and options
+# of the parent's source, and is given the parent's validator metadata
+
+_worker_chaind = None
+
+def _init_worker(window, source_type, options, validators):
+    global _worker_chaind
+    _worker_chaind = ChainDB(
+        source_type(**options),
+        read_only=True,
+        prefetch_window=window,
+        metrics=Metrics(),
+        validators=ValidatorStore.from_columns(validators)
+    )
+
+def _chunk_increments(epochs):
+    metrics = _worker_chaind.metrics
+    results = []
+    for e in epochs:
+        with metrics.stage('fetch'):
+            data = fetch_epoch(_worker_chaind, e)
+        increments = epoch_increments(data, metrics)
+        # per-epoch attestation increments fit in 32 bits, which halves the
+        # data pickled back to the parent process
+        for field in ATTESTATION_INCREMENTS:
+            increments[field] = increments[field].astype(np.int32)
+        increments['attestors'] = increments['attestors'].astype(np.int32)
+        increments['slots'] = increments['slots'].astype(np.int8)
+        results.append((e, increments))
+    # worker timings are returned with the chunk and merged by the parent
+    return results, metrics.take()
+
+def parallel_epochs(chaind, e, end, processes, chunk_size):
+    # calculate increments for chunks of epochs on a process pool and merge
+    # them into the cumulative state strictly in epoch order
+    chunks = [
+        range(start, min(start + chunk_size, end))
+        for start in range(e, end, chunk_size)
+    ]
+    source = chaind.source
+    init_args = (
+        chunk_size, type(source), source.options, chaind.validators.to_columns()
+    )
+    with multiprocessing.Pool(processes, _init_worker, init_args) as pool:
+        for results, worker_metrics in pool.imap(_chunk_increments, chunks):
+            chaind.metrics.merge(worker_metrics)
+            for e, increments in results:
+                with chaind.metrics.stage('apply'):
+                    apply_increments(chaind.validators, e, increments)
+                yield e
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--reset', action='store_true')
+    parser.add_argument(
+        '-w', '--window', type=int, default=16,
+        help="number of epochs of chain data to prefetch per batch of "
+             "range queries (0 queries each epoch and slot individually)"
+    )
+    parser.add_argument(
+        '-e', '--engine', choices=('python', 'numpy'), default='python',
+        help="compute attestation rewards with the per-attestor loop or with "
+             "array operations over all attestors of an epoch"
+    )
+    parser.add_argument(
+        '-b', '--batch-size', type=int, default=8,
+        help="number of epochs written per COPY transaction"
+    )
+    parser.add_argument(
+        '--text-copy', action='store_true',
+        help="use the COPY text format instead of binary"
+    )
+    parser.add_argument(
+        '-k', '--checkpoint-interval', type=int, default=0,
+        help="store full cumulative values every K epochs and per-epoch "
+             "deltas in between (0 stores every epoch in full)"
+    )
+    parser.add_argument(
+        '--pipeline', type=int, default=0, metavar='DEPTH',
+        help="fetch (numpy engine) and write epochs on background threads "
+             "with their own connections, queueing up to DEPTH epochs"
+    )
+    parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help="number of worker processes calculating epochs in parallel "
+             "(uses the numpy engine, with chunks of --window epochs)"
+    )
+    add_arguments(parser)
+    fingerprints.add_arguments(parser)
+    data_sources.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics = from_args(args)
+    chaind = ChainDB(
+        data_sources.from_args(args),
+        metrics=metrics,
+        reset=args.reset,
+        prefetch_window=args.window,
+        write_batch_size=args.batch_size,
+        binary_copy=not args.text_copy,
+        checkpoint_interval=args.checkpoint_interval,
+        write_queue_depth=args.pipeline,
+        reorg_depth=args.reorg_depth
+    )
+    if chaind.rollback_epoch is not None:
+        print(f"chain data changed: recalculating from epoch "
+              f"{chaind.rollback_epoch}")
+
+    latest_epoch = chaind.get_latest_extras_epoch()
+    if latest_epoch is None:
+        e = 0
+    else:
+        e = latest_epoch + 1
+
+    latest_epoch = chaind.get_latest_summary_epoch()
+    if args.processes > 1:
+        epochs = parallel_epochs(
+            chaind, e, latest_epoch - 1, args.processes, max(args.window, 1)
+        )
+    elif args.engine == 'numpy' and args.pipeline:
+        epochs = pipelined_epochs(chaind, e, latest_epoch - 1, args.pipeline)
+    elif args.engine == 'numpy':
+        epochs = vectorized_epochs(chaind, e, latest_epoch - 1)
+    else:
+        epochs = reference_epochs(chaind, e, latest_epoch - 1)
+
+    metrics.start(e)
+    try:
+        for e in epochs:
+            chaind.insert_epoch_extras(e)
+            metrics.epoch_done(e)
+            print(f"calculated validator epoch extras for epoch {e}", end='\r')
+    except KeyboardInterrupt:
+        # uncommitted epochs are discarded and recalculated on the next run
+        chaind.writer.discard()
+        metrics.close()
+        print(f"\ninterrupted during processing for epoch {e}")
+        sys.exit(0)
+
+    chaind.save_state()
+    metrics.close()
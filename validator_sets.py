@@ -0,0 +1,110 @@
+import hashlib
+import os
+
+import numpy as np
+
+_cache = {}
+
+class ValidatorSets:
+    # validators whose balance changes are not rewards for their own duties:
+    # slashed validators, slashers and validators receiving repeat deposits.
+    # sets are sorted int64 arrays of validator indices, and each repeat
+    # deposit is kept as (validator, balance epoch, amount)
+
+    def __init__(self, head, slashed, slashers, deposits):
+        self.head = head
+        self.slashed = slashed
+        self.slashers = slashers
+        self.deposits = deposits.reshape(-1, 3)
+        self.redeposits = np.unique(self.deposits[:, 0])
+
+    def mask(self, n_validators, slashed=True, slashers=True, redeposits=True):
+        # boolean mask over validators 0..n-1 of the selected sets
+        mask = np.zeros(n_validators, dtype=bool)
+        for selected, indices in (
+            (slashed, self.slashed),
+            (slashers, self.slashers),
+            (redeposits, self.redeposits)
+        ):
+            if selected:
+                mask[indices[indices < n_validators]] = True
+        return mask
+
+    def slashed_digest(self):
+        # digest of the slashed and slasher sets, which changes when more
+        # validators are found to be slashed or slashers
+        digest = hashlib.md5(np.asarray(self.slashed, np.int64).tobytes())
+        digest.update(b'/')
+        digest.update(np.asarray(self.slashers, np.int64).tobytes())
+        return digest.hexdigest()
+
+    def deposits_by_epoch(self):
+        # total repeat deposit amount by the epoch it reaches the balances
+        epochs, inverse = np.unique(self.deposits[:, 1], return_inverse=True)
+        amounts = np.zeros(len(epochs), dtype=np.int64)
+        np.add.at(amounts, inverse, self.deposits[:, 2])
+        return dict(zip(epochs.tolist(), amounts.tolist()))
+
+    def save(self, path):
+        slot, root = (-1, '') if self.head is None else self.head
+        np.savez(
+            path,
+            head_slot=slot,
+            head_root=root,
+            slashed=self.slashed,
+            slashers=self.slashers,
+            deposits=self.deposits
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            slot, root = int(f['head_slot']), str(f['head_root'])
+            head = None if slot < 0 else (slot, root)
+            return cls(head, f['slashed'], f['slashers'], f['deposits'])
+
+def read_digest(path):
+    # digest recorded in a file, or None
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip() or None
+
+def write_digest(path, digest):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(digest)
+    os.replace(tmp_path, path)
+
+def classify_validators(source, path=None):
+    # slashed, slasher and repeat deposit validator sets, using one query per
+    # set. the result is cached per chain head, in memory and in path (by
+    # default validator_sets.npz in the source's cache directory), so it is
+    # only recomputed when the chain has progressed
+    head = source.chain_head()
+    key = (source.key, head)
+    if key in _cache:
+        return _cache[key]
+    if path is None:
+        path = source.cache_path('validator_sets.npz')
+    if os.path.exists(path):
+        sets = ValidatorSets.load(path)
+        if sets.head == head:
+            _cache[key] = sets
+            return sets
+
+    sets = ValidatorSets(
+        head,
+        source.slashed_validators(),
+        source.slashers(),
+        source.repeat_deposits()
+    )
+
+    # write to a temporary file first so a partial cache is never read
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    sets.save(tmp_path)
+    os.replace(tmp_path, path)
+    _cache[key] = sets
+    return sets
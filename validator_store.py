@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+
+FUTURE_EPOCH = 2**64 - 1 # as defined in eth2 spec
+FUTURE_EPOCH_SENTINEL = np.iinfo(np.int64).max # FUTURE_EPOCH in int64 columns
+
+PUBKEY_LENGTH = 48
+
+# column name -> dtype, for every per-validator field
+
+METADATA_FIELDS = {
+    'activation_epoch'      : np.int64,
+    'exit_epoch'            : np.int64,
+    'slashed'               : bool,
+    'slashed_slot'          : np.int64, # -1 for none
+    'slasher'               : bool,
+    'redeposit'             : bool
+}
+
+ACCUMULATOR_FIELDS = {
+    'attestation_reward'    : np.int64,
+    'max_attestation_reward': np.int64,
+    'shortfall_missed'      : np.int64,
+    'shortfall_target'      : np.int64,
+    'shortfall_head'        : np.int64,
+    'shortfall_delay'       : np.int64,
+    'block_reward'          : np.int64,
+    'missed_block_reward'   : np.int64
+}
+
+EPOCH_FIELDS = {
+    'attestation_slot'      : np.int64, # -1 for none
+    'this_att_reward'       : np.int64,
+    'effective_balance'     : np.int64,
+    'proposer_duties'       : np.int64,
+    'proposals_included'    : np.int64,
+    'attestation_included'  : bool,
+    'target_correct'        : bool,
+    'head_correct'          : bool,
+    'inclusion_delay'       : np.int64  # 0 for none
+}
+
+FIELDS = {**METADATA_FIELDS, **ACCUMULATOR_FIELDS, **EPOCH_FIELDS}
+
+# columns of t_validator_epoch_extras after f_epoch and f_validator_index
+
+EXTRAS_FIELDS = ['attestation_slot'] + list(ACCUMULATOR_FIELDS)
+
+NULLABLE = {'slashed_slot': -1, 'attestation_slot': -1}
+
+class ValidatorRecord:
+    # dict-style view of a single validator, backed by the store's columns
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'index':
+            return self.index
+        if key == 'pubkey':
+            return self.store.pubkeys[self.index].tobytes().hex()
+        value = self.store.columns[key][self.index].item()
+        if key in ('activation_epoch', 'exit_epoch'):
+            return FUTURE_EPOCH if value == FUTURE_EPOCH_SENTINEL else value
+        if key in NULLABLE and value == NULLABLE[key]:
+            return None
+        return value
+
+    def __setitem__(self, key, value):
+        if key in ('activation_epoch', 'exit_epoch') and value == FUTURE_EPOCH:
+            value = FUTURE_EPOCH_SENTINEL
+        elif value is None:
+            value = NULLABLE.get(key, 0)
+        self.store.columns[key][self.index] = value
+
+class ValidatorStore:
+    # per-validator state held as one typed array per field, indexed by
+    # validator index
+
+    def __init__(self, n):
+        self.columns = {k: np.zeros(n, dtype=t) for k, t in FIELDS.items()}
+        for k, null in NULLABLE.items():
+            self.columns[k][:] = null
+        self.pubkeys = np.zeros((n, PUBKEY_LENGTH), dtype=np.uint8)
+
+    @classmethod
+    def from_columns(cls, columns):
+        # activation_epoch, exit_epoch, slashed and pubkeys arrays ordered by
+        # index, as returned by a data source's validators()
+        store = cls(len(columns['activation_epoch']))
+        for field in ('activation_epoch', 'exit_epoch', 'slashed'):
+            store.columns[field][:] = columns[field]
+        store.pubkeys[:] = columns['pubkeys']
+        return store
+
+    def to_columns(self):
+        # the validator metadata in the form read by from_columns
+        columns = {
+            field: self.columns[field]
+            for field in ('activation_epoch', 'exit_epoch', 'slashed')
+        }
+        columns['pubkeys'] = self.pubkeys
+        return columns
+
+    @classmethod
+    def load(cls, path):
+        # (store, epoch, chain head) as written by save
+        with np.load(path) as f:
+            store = cls(len(f['activation_epoch']))
+            for field in FIELDS:
+                store.columns[field][:] = f[field]
+            store.pubkeys[:] = f['pubkeys']
+            slot, root = int(f['head_slot']), str(f['head_root'])
+            epoch = int(f['epoch'])
+        return store, epoch, None if slot < 0 else (slot, root)
+
+    def save(self, path, epoch, head):
+        # write every column, with the epoch they are current to and the
+        # chain head the validators were read at. the file is replaced
+        # atomically, so it is never left incomplete
+        slot, root = (-1, '') if head is None else head
+        tmp_path = path + '.tmp.npz'
+        np.savez(
+            tmp_path,
+            epoch=epoch,
+            head_slot=slot,
+            head_root=root,
+            pubkeys=self.pubkeys,
+            **self.columns
+        )
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.columns['activation_epoch'])
+
+    def __getitem__(self, index):
+        return ValidatorRecord(self, index)
+
+    def __iter__(self):
+        return (ValidatorRecord(self, i) for i in range(len(self)))
+
+    def active(self, epoch):
+        # boolean mask of validators active in the epoch
+        return (self.columns['activation_epoch'] <= epoch) \
+             & (epoch < self.columns['exit_epoch'])
+
+    def epoch_extras_rows(self, epoch):
+        # t_validator_epoch_extras rows for validators active in the epoch,
+        # as a 2D int64 array (attestation slot is -1 where null)
+        index = np.flatnonzero(self.active(epoch))
+        rows = np.empty((len(index), 2 + len(EXTRAS_FIELDS)), dtype=np.int64)
+        rows[:, 0] = epoch
+        rows[:, 1] = index
+        for i, field in enumerate(EXTRAS_FIELDS):
+            rows[:, i + 2] = self.columns[field][index]
+        return rows